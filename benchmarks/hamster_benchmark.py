@@ -0,0 +1,534 @@
+#!/usr/bin/env python
+'''Benchmark the Hamster plugin against a fake Hamster service.
+
+A private dbus-daemon is started together with a stand-in for the part of
+org.gnome.Hamster that hamster.py uses. The size of the dataset and the
+latency of every call of the fake service can be chosen, so the effect of a
+busy Hamster can be measured as well. Results are written as JSON, which
+makes it easy to compare runs across commits:
+
+    python benchmarks/hamster_benchmark.py --facts-per-day 20 --days 60 \
+        --latency 5 --output results.json
+
+The same dataset is also written to a Hamster SQLite database, to compare
+reading the catalog from the database with reading it over D-Bus.
+
+Kupfer itself has to be importable (use --kupfer-path if it is not
+installed). Cache and data files are written to a temporary directory, and
+notifications are not shown while benchmarking.
+'''
+from __future__ import print_function
+
+import argparse
+import calendar
+import datetime
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+HAMSTER_BUS_NAME = 'org.gnome.Hamster'
+HAMSTER_OBJECT_PATH = '/org/gnome/Hamster'
+HAMSTER_INTERFACE = 'org.gnome.Hamster'
+BENCHMARK_INTERFACE = 'org.gnome.Hamster.Benchmark'
+FACT_SIGNATURE = '(iiissisasii)'
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_glib():
+    try:
+        from gi.repository import GLib
+        return GLib
+    except ImportError:
+        import glib
+        return glib
+
+
+def get_main_context():
+    glib = get_glib()
+    if hasattr(glib, 'MainContext'):
+        return glib.MainContext.default()
+    return glib.main_context_default()
+
+
+def local_timestamp(day, hour, minute=0):
+    '''Hamster stores local times as if they were UTC'''
+    return calendar.timegm((day.year, day.month, day.day, hour, minute, 0, 0, 0, 0))
+
+
+def generate_dataset(args):
+    '''Return the activities, tags and facts of the benchmark dataset'''
+    activities = [('activity %d' % i, 'category %d' % (i % 50)) for i in range(args.activities)]
+    tags = ['tag%d' % i for i in range(args.tags)]
+    facts = []
+    today = datetime.date.today()
+    for offset in range(args.days):
+        day = today - datetime.timedelta(days=offset)
+        for i in range(args.facts_per_day):
+            start = local_timestamp(day, 8) + i * 1800
+            activity, category = activities[(offset + i) % len(activities)]
+            fact_tags = [tags[i % len(tags)]] if tags else []
+            facts.append((start, start + 1500, 'description %d' % i, activity, category, fact_tags))
+    return activities, tags, facts
+
+
+def create_database(filename, args):
+    '''Write the benchmark dataset as a Hamster (schema version 9) database'''
+    activities, tags, facts = generate_dataset(args)
+    os.makedirs(os.path.dirname(filename))
+    connection = sqlite3.connect(filename)
+    connection.executescript('''
+        CREATE TABLE version (version INTEGER);
+        INSERT INTO version VALUES (9);
+        CREATE TABLE categories (id INTEGER PRIMARY KEY, name VARCHAR2(500), color_code VARCHAR2(50),
+                                 category_order INTEGER, search_name VARCHAR2);
+        CREATE TABLE activities (id INTEGER PRIMARY KEY, name VARCHAR2(500), work INTEGER,
+                                 activity_order INTEGER, deleted INTEGER, category_id INTEGER,
+                                 search_name VARCHAR2);
+        CREATE TABLE facts (id INTEGER PRIMARY KEY, activity_id INTEGER, start_time TIMESTAMP,
+                            end_time TIMESTAMP, description VARCHAR2);
+        CREATE TABLE tags (id INTEGER PRIMARY KEY, name TEXT NOT NULL, autocomplete BOOL DEFAULT true);
+        CREATE TABLE fact_tags (fact_id INTEGER, tag_id INTEGER);
+        CREATE INDEX idx_facts_start_end ON facts(start_time, end_time);
+        CREATE INDEX idx_fact_tags_fact ON fact_tags(fact_id);
+    ''')
+    categories = {}
+    activity_ids = {}
+    for activity, category in activities:
+        if category not in categories:
+            categories[category] = len(categories) + 1
+            connection.execute("INSERT INTO categories (id, name, search_name) VALUES (?, ?, ?)",
+                               (categories[category], category, category.lower()))
+        activity_ids[(activity, category)] = len(activity_ids) + 1
+        connection.execute("INSERT INTO activities (id, name, category_id, search_name) VALUES (?, ?, ?, ?)",
+                           (activity_ids[(activity, category)], activity, categories[category], activity.lower()))
+    tag_ids = dict((tag, i + 1) for i, tag in enumerate(tags))
+    connection.executemany("INSERT INTO tags (id, name, autocomplete) VALUES (?, ?, 'true')",
+                           [(tag_id, tag) for tag, tag_id in tag_ids.items()])
+
+    def format_time(timestamp):
+        return datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+    for fact_id, (start, end, description, activity, category, fact_tags) in enumerate(facts, 1):
+        connection.execute("INSERT INTO facts VALUES (?, ?, ?, ?, ?)",
+                           (fact_id, activity_ids[(activity, category)], format_time(start),
+                            format_time(end), description))
+        connection.executemany("INSERT INTO fact_tags VALUES (?, ?)",
+                               [(fact_id, tag_ids[tag]) for tag in fact_tags])
+    connection.commit()
+    connection.close()
+
+
+# {{{ fake Hamster service
+def serve(args):
+    import dbus
+    import dbus.service
+    import dbus.mainloop.glib
+
+    class FakeHamster (dbus.service.Object):
+        def __init__(self, bus, args):
+            dbus.service.Object.__init__(self, bus, HAMSTER_OBJECT_PATH)
+            self.latency = args.latency / 1000.0
+            self.activities, tags, facts = generate_dataset(args)
+            self.tags = [(i + 1, tag, True) for i, tag in enumerate(tags)]
+            self.facts = {}
+            self.next_id = 1
+            for start, end, description, activity, category, fact_tags in facts:
+                self._store(start, end, description, activity, category, fact_tags)
+
+        def _delay(self):
+            if self.latency:
+                time.sleep(self.latency)
+
+        def _store(self, start, end, description, activity, category, tags):
+            fact_id = self.next_id
+            self.next_id += 1
+            self.facts[fact_id] = [fact_id, start, end, description, activity, 1, category, tags]
+            return fact_id
+
+        def _parse(self, fact):
+            name, _sep, rest = fact.partition(',')
+            activity, _sep, category = name.strip().partition('@')
+            words = rest.split()
+            tags = [word[1:] for word in words if word.startswith('#')]
+            description = ' '.join(word for word in words if not word.startswith('#'))
+            return activity, category, description, tags
+
+        def _to_struct(self, fact):
+            fact_id, start, end, description, activity, activity_id, category, tags = fact
+            day = local_timestamp(datetime.datetime.utcfromtimestamp(start).date(), 0)
+            delta = (end or local_timestamp(datetime.date.today(), 0)) - start
+            return dbus.Struct((fact_id, start, end, description, activity, activity_id, category,
+                                dbus.Array(tags, signature='s'), day, delta), signature=FACT_SIGNATURE)
+
+        def _facts_between(self, first, last):
+            facts = [fact for fact in self.facts.values()
+                     if first <= datetime.datetime.utcfromtimestamp(fact[1]).date() <= last]
+            facts.sort(key=lambda fact: fact[1])
+            return dbus.Array([self._to_struct(fact) for fact in facts], signature=FACT_SIGNATURE)
+
+        def _stop_running(self, end_time):
+            for fact in self.facts.values():
+                if fact[2] == 0:
+                    fact[2] = end_time
+
+        @dbus.service.signal(HAMSTER_INTERFACE)
+        def FactsChanged(self):
+            pass
+
+        @dbus.service.signal(HAMSTER_INTERFACE)
+        def TagsChanged(self):
+            pass
+
+        @dbus.service.method(HAMSTER_INTERFACE, in_signature='siib', out_signature='i')
+        def AddFact(self, fact, start_time, end_time, temporary):
+            self._delay()
+            if not end_time:
+                self._stop_running(start_time)
+            activity, category, description, tags = self._parse(fact)
+            fact_id = self._store(start_time, end_time, description, activity, category, tags)
+            self.FactsChanged()
+            return fact_id
+
+        @dbus.service.method(HAMSTER_INTERFACE, in_signature='i', out_signature=FACT_SIGNATURE)
+        def GetFact(self, fact_id):
+            self._delay()
+            return self._to_struct(self.facts[fact_id])
+
+        @dbus.service.method(HAMSTER_INTERFACE, in_signature='isiib', out_signature='i')
+        def UpdateFact(self, fact_id, fact, start_time, end_time, temporary):
+            self._delay()
+            # like Hamster: the old fact is removed and a new one is added
+            del self.facts[fact_id]
+            self.FactsChanged()
+            activity, category, description, tags = self._parse(fact)
+            new_id = self._store(start_time, end_time, description, activity, category, tags)
+            self.FactsChanged()
+            return new_id
+
+        @dbus.service.method(HAMSTER_INTERFACE, in_signature='i', out_signature='')
+        def RemoveFact(self, fact_id):
+            self._delay()
+            self.facts.pop(fact_id, None)
+            self.FactsChanged()
+
+        @dbus.service.method(HAMSTER_INTERFACE, in_signature='i', out_signature='')
+        def StopTracking(self, end_time):
+            self._delay()
+            self._stop_running(end_time)
+            self.FactsChanged()
+
+        @dbus.service.method(HAMSTER_INTERFACE, in_signature='', out_signature='a' + FACT_SIGNATURE)
+        def GetTodaysFacts(self):
+            self._delay()
+            today = datetime.date.today()
+            return self._facts_between(today, today)
+
+        @dbus.service.method(HAMSTER_INTERFACE, in_signature='uus', out_signature='a' + FACT_SIGNATURE)
+        def GetFacts(self, start_date, end_date, search_terms):
+            self._delay()
+            return self._facts_between(datetime.datetime.utcfromtimestamp(start_date).date(),
+                                       datetime.datetime.utcfromtimestamp(end_date).date())
+
+        @dbus.service.method(HAMSTER_INTERFACE, in_signature='s', out_signature='a(ss)')
+        def GetActivities(self, search):
+            self._delay()
+            return dbus.Array(self.activities, signature='(ss)')
+
+        @dbus.service.method(HAMSTER_INTERFACE, in_signature='b', out_signature='a(isb)')
+        def GetTags(self, only_autocomplete):
+            self._delay()
+            return dbus.Array(self.tags, signature='(isb)')
+
+        @dbus.service.method(HAMSTER_INTERFACE, in_signature='', out_signature='')
+        def Toggle(self):
+            self._delay()
+
+        @dbus.service.method(BENCHMARK_INTERFACE, in_signature='', out_signature='')
+        def Ping(self):
+            # answered without latency once the calls before it are done
+            pass
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.SessionBus()
+    name = dbus.service.BusName(HAMSTER_BUS_NAME, bus)
+    service = FakeHamster(bus, args)
+    get_glib().MainLoop().run()
+# }}}
+
+
+class Context (object):
+    '''Stands in for Kupfer's execution context and collects late results'''
+    def __init__(self):
+        self.results = []
+
+    def register_late_result(self, result):
+        self.results.append(result)
+
+
+class Settings (dict):
+    '''Plugin settings that can be changed while benchmarking'''
+    def __init__(self, settings):
+        dict.__init__(self)
+        self.settings = settings
+
+    def __missing__(self, key):
+        return self.settings[key]
+
+
+class Benchmark (object):
+    def __init__(self, args):
+        self.args = args
+        self.results = {}
+        self.context = get_main_context()
+
+    def iterate(self):
+        while self.context.pending():
+            self.context.iteration(False)
+
+    def settle(self):
+        '''Wait until the fake service has answered every call sent so far,
+        including the ones the plugin sends in the background, so they do
+        not delay the next run.'''
+        for i in range(2):
+            self.iterate()
+            self.interface.Ping(dbus_interface=BENCHMARK_INTERFACE)
+        self.iterate()
+
+    def run_until(self, predicate, timeout=30):
+        deadline = time.time() + timeout
+        while not predicate():
+            if time.time() > deadline:
+                raise RuntimeError("timed out waiting for Hamster")
+            if self.context.pending():
+                self.context.iteration(False)
+            else:
+                time.sleep(0.0005)
+
+    def measure(self, name, func, setup=None):
+        '''Time `func`, after calling `setup` before every run. Whatever
+        `setup` returns, if anything, is passed to `func`.'''
+        timings = []
+        for i in range(self.args.repeat):
+            argument = setup() if setup else None
+            self.settle()
+            start = time.time()
+            if argument is None:
+                func()
+            else:
+                func(argument)
+            timings.append((time.time() - start) * 1000)
+            self.settle()
+        timings.sort()
+        self.results[name] = {
+            'runs': len(timings),
+            'min_ms': round(timings[0], 3),
+            'median_ms': round(timings[len(timings) // 2], 3),
+            'mean_ms': round(sum(timings) / len(timings), 3),
+        }
+        print("%-50s %10.3f ms" % (name, self.results[name]['median_ms']))
+
+    def run(self):
+        from kupfer.objects import TextLeaf
+        import hamster
+        self.hamster = hamster
+        self.settings = Settings(hamster.__kupfer_settings__)
+        self.settings['read_database'] = False
+        hamster.__kupfer_settings__ = self.settings
+        hamster.uiutils.show_notification = lambda *args, **kwargs: 0
+        interface = hamster.get_hamster()
+        self.interface = interface
+        source = hamster.HamsterSource()
+        source.initialize()
+        self.run_until(lambda: hamster.activity_catalog.activities)
+
+        def refresh_catalog():
+            hamster.activity_catalog.activities = []
+            hamster.activity_catalog.refresh()
+            self.run_until(lambda: hamster.activity_catalog.activities)
+
+        def call_with_new_proxy():
+            import dbus
+            bus = dbus.SessionBus()
+            proxy = dbus.Interface(bus.get_object(HAMSTER_BUS_NAME, HAMSTER_OBJECT_PATH),
+                                   dbus_interface=HAMSTER_INTERFACE)
+            proxy.GetTodaysFacts()
+
+        # what every action paid before the plugin kept one proxy
+        self.measure('GetTodaysFacts, new introspected proxy', call_with_new_proxy)
+        self.measure('GetTodaysFacts, shared proxy', lambda: interface.GetTodaysFacts())
+        self.measure('ActivityCatalog.refresh', refresh_catalog)
+        self.measure('HamsterSource.get_items',
+                     lambda: list(source.get_items()), setup=source.activities_source.mark_for_update)
+        self.measure('ActivitiesSource.get_items', lambda: list(hamster.ActivitiesSource().get_items()))
+        self.measure('ActivityIndex.query', lambda: hamster.activity_index.query('activity 1', 10))
+        self.measure('TagsSource.get_items (cold)', lambda: list(hamster.TagsSource().get_items()),
+                     setup=hamster.tag_cache.invalidate)
+        self.measure('TagsSource.get_items (cached)', lambda: list(hamster.TagsSource().get_items()))
+        self.measure('FactsSource.get_items (cold)', lambda: list(hamster.FactsSource().get_items()),
+                     setup=self.reset_facts_cache)
+        self.measure('ThisWeekFactsSource.get_items (cold)',
+                     lambda: list(hamster.ThisWeekFactsSource().get_items()), setup=self.reset_facts_cache)
+        self.measure('ShowHamsterInfo.run', lambda: hamster.ShowHamsterInfo().run())
+
+        last = datetime.date.today()
+        first = last - datetime.timedelta(days=self.args.days - 1)
+        for backend in ('dbus', 'sqlite'):
+            self.settings['read_database'] = backend == 'sqlite'
+            self.measure('ActivityCatalog.refresh (%s)' % backend, refresh_catalog)
+            self.measure('TagsSource.get_items (%s)' % backend, lambda: list(hamster.TagsSource().get_items()),
+                         setup=hamster.tag_cache.invalidate)
+            self.measure('DateRangeFactsSource.get_items, all days (%s)' % backend,
+                         lambda: list(hamster.DateRangeFactsSource(first, last).get_items()),
+                         setup=self.reset_facts_cache)
+        self.settings['read_database'] = False
+
+        activity = hamster.ActivityLeaf('activity 1@category 1')
+        text = TextLeaf('benchmark')
+        for async_actions in (False, True):
+            self.settings['async_actions'] = async_actions
+            mode = 'async' if async_actions else 'sync'
+            self.measure_start('StartActivity.activate (%s)' % mode,
+                               lambda ctx: hamster.StartActivity().activate(activity, ctx))
+            self.measure_start('StartActivityWithTags.activate (%s)' % mode,
+                               lambda ctx: hamster.StartActivityWithTags().activate(
+                                   activity, hamster.TagLeaf('tag1'), ctx))
+            self.measure_start('StartActivityWithDescription.activate (%s)' % mode,
+                               lambda ctx: hamster.StartActivityWithDescription().activate(activity, text, ctx))
+            for action, iobj in ((hamster.ChangeStartTime(), TextLeaf('8:15')),
+                                 (hamster.ChangeEndTime(), TextLeaf('8:45')),
+                                 (hamster.ChangeDescription(), text),
+                                 (hamster.ChangeTags(), hamster.TagLeaf('tag2')),
+                                 (hamster.EditFact(), TextLeaf('8:00-8:30 #tag1, benchmark'))):
+                self.measure_edit('%s.activate (%s)' % (type(action).__name__, mode), action, iobj)
+            self.measure('Remove.activate (%s)' % mode,
+                         lambda leaf: hamster.Remove().activate(leaf), setup=self.new_fact)
+            self.measure('StopTrackingLeaf.run (%s)' % mode, lambda: hamster.StopTrackingLeaf().run())
+        self.measure('Toggle.activate', lambda: hamster.Toggle().activate(None))
+        return self.results
+
+    def reset_facts_cache(self):
+        self.hamster.facts_cache = self.hamster.FactsCache()
+
+    def new_fact(self):
+        start = self.hamster.get_timestamp() - 3600
+        fact_id = self.interface.AddFact('benchmark@benchmark', start, start + 600, False)
+        return self.hamster.FactLeaf(self.interface.GetFact(fact_id))
+
+    def measure_start(self, name, activate):
+        self.measure(name, lambda ctx: activate(ctx), setup=Context)
+        if self.settings['async_actions']:
+            # the time until the started fact is handed back to Kupfer
+            def start(ctx):
+                activate(ctx)
+                self.run_until(lambda: ctx.results)
+            self.measure(name + ' until result', start, setup=Context)
+
+    def measure_edit(self, name, action, iobj):
+        self.measure(name, lambda leaf: action.activate(leaf, iobj, Context()), setup=self.new_fact)
+        if self.settings['async_actions']:
+            def edit(leaf):
+                ctx = Context()
+                action.activate(leaf, iobj, ctx)
+                self.run_until(lambda: ctx.results)
+            self.measure(name + ' until result', edit, setup=self.new_fact)
+
+
+def start_bus():
+    daemon = subprocess.Popen(['dbus-daemon', '--session', '--nofork', '--print-address=1'],
+                              stdout=subprocess.PIPE, universal_newlines=True)
+    address = daemon.stdout.readline().strip()
+    os.environ['DBUS_SESSION_BUS_ADDRESS'] = address
+    return daemon
+
+
+def wait_for_service(timeout=30):
+    import dbus
+    bus = dbus.SessionBus()
+    deadline = time.time() + timeout
+    while not bus.name_has_owner(HAMSTER_BUS_NAME):
+        if time.time() > deadline:
+            raise RuntimeError("fake Hamster service did not start")
+        time.sleep(0.05)
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--activities', type=int, default=1000)
+    parser.add_argument('--tags', type=int, default=100)
+    parser.add_argument('--facts-per-day', type=int, default=20)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--latency', type=float, default=0, help="latency of every call in ms")
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--output', default='-', help="file to write the JSON results to")
+    parser.add_argument('--kupfer-path', help="directory containing the kupfer package")
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args)
+        return
+
+    tmpdir = tempfile.mkdtemp(prefix='hamster-benchmark-')
+    for variable in ('XDG_CACHE_HOME', 'XDG_DATA_HOME', 'XDG_CONFIG_HOME'):
+        os.environ[variable] = os.path.join(tmpdir, variable.lower())
+    create_database(os.path.join(os.environ['XDG_DATA_HOME'], 'hamster-applet', 'hamster.db'), args)
+    daemon = start_bus()
+    service = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve'] + sys.argv[1:])
+    try:
+        # the shared session bus connection must be created with the main
+        # loop, or the asynchronous calls of the plugin never get a reply
+        import dbus.mainloop.glib
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        wait_for_service()
+        if args.kupfer_path:
+            sys.path.insert(0, args.kupfer_path)
+        sys.path.insert(0, REPO_DIR)
+        try:
+            import builtins
+        except ImportError:
+            import __builtin__ as builtins
+        if not hasattr(builtins, '_'):
+            builtins._ = lambda text: text
+        results = Benchmark(args).run()
+    finally:
+        service.terminate()
+        daemon.terminate()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    report = {
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'dataset': {
+            'activities': args.activities,
+            'tags': args.tags,
+            'facts_per_day': args.facts_per_day,
+            'days': args.days,
+            'latency_ms': args.latency,
+        },
+        'results': results,
+    }
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: fdm=marker
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+'''Benchmark how the Hamster plugin's in-memory structures scale.
+
+Measures building and querying the ActivityIndex for catalogs of several
+sizes, and building FactLeafs for a large number of facts, with the time
+and (on Python 3) the memory they take. Nothing is asked from Hamster, so
+no fake service is needed; a private dbus-daemon is still started so the
+plugin can be imported. Results are written as JSON:
+
+    python benchmarks/hamster_scaling_benchmark.py --sizes 1000,10000,100000 \
+        --fact-leaves 50000 --output scaling.json
+
+Kupfer itself has to be importable (use --kupfer-path if it is not
+installed). Cache and data files are written to a temporary directory.
+'''
+from __future__ import print_function
+
+import argparse
+import calendar
+import datetime
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from hamster_benchmark import REPO_DIR, get_commit, start_bus
+
+QUERIES = ('d', 're', 'meet', 'client 12')
+WORDS = ('meeting', 'review', 'development', 'design', 'support', 'client', 'planning', 'research')
+
+
+class Catalog (object):
+    '''Stands in for the ActivityCatalog the index is built from'''
+    def __init__(self, activities):
+        self.activities = activities
+
+    def connect(self, callback):
+        pass
+
+
+def generate_activities(size):
+    random.seed(size)
+    return ['%s %d@category %d' % (random.choice(WORDS), i, i % 50) for i in range(size)]
+
+
+def generate_facts(count):
+    today = datetime.date.today()
+    start = calendar.timegm(today.timetuple())
+    return [(i, start + i * 60, start + i * 60 + 50, 'description %d' % i, 'activity %d' % (i % 500),
+             i % 500, 'category %d' % (i % 50), ['tag%d' % (i % 20)], start, 50)
+            for i in range(count)]
+
+
+def measure_memory(func):
+    '''Return the result of `func`, the time it took in ms and the memory
+    still allocated by it afterwards in MiB.
+
+    Tracing allocations slows Python down a lot, so `func` is timed in a
+    separate run.'''
+    gc.collect()
+    start = time.time()
+    result = func()
+    duration = (time.time() - start) * 1000
+    memory = None
+    if tracemalloc is not None:
+        del result
+        gc.collect()
+        tracemalloc.start()
+        result = func()
+        memory = tracemalloc.get_traced_memory()[0] / float(1 << 20)
+        tracemalloc.stop()
+    return result, duration, memory
+
+
+def benchmark_index(hamster, size, used, repeat):
+    activities = generate_activities(size)
+    usage = hamster.ActivityUsage(os.path.join(tempfile.mkdtemp(), 'usage.pickle'))
+    now = time.time()
+    for activity in random.sample(activities, min(used, size)):
+        usage.usage[activity] = (random.randint(1, 20), now - random.randint(0, 60 * 24 * 3600))
+    index = hamster.ActivityIndex(Catalog(activities), usage)
+    _result, build_ms, memory = measure_memory(index._build)
+    queries = {}
+    for query in QUERIES:
+        timings = []
+        for i in range(repeat):
+            start = time.time()
+            index.query(query, 10)
+            timings.append((time.time() - start) * 1000)
+        timings.sort()
+        queries[query] = round(timings[len(timings) // 2], 4)
+    print("ActivityIndex, %7d activities, %5d used: build %8.1f ms, query %s" % (size, used, build_ms, queries))
+    return {
+        'build_ms': round(build_ms, 1),
+        'memory_mib': memory and round(memory, 2),
+        'median_query_ms': queries,
+    }
+
+
+def benchmark_fact_leaves(hamster, count):
+    facts = generate_facts(count)
+    leaves, duration, memory = measure_memory(lambda: [hamster.FactLeaf(fact) for fact in facts])
+    print("FactLeaf, %7d leaves: %8.1f ms, %s MiB" % (count, duration, memory and round(memory, 2)))
+    return {
+        'leaves': len(leaves),
+        'ms': round(duration, 1),
+        'memory_mib': memory and round(memory, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help="comma separated catalog sizes for the activity index")
+    parser.add_argument('--used', type=int, default=500,
+                        help="number of activities with a usage history")
+    parser.add_argument('--fact-leaves', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--output', default='-', help="file to write the JSON results to")
+    parser.add_argument('--kupfer-path', help="directory containing the kupfer package")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='hamster-benchmark-')
+    for variable in ('XDG_CACHE_HOME', 'XDG_DATA_HOME', 'XDG_CONFIG_HOME'):
+        os.environ[variable] = os.path.join(tmpdir, variable.lower())
+    daemon = start_bus()
+    try:
+        if args.kupfer_path:
+            sys.path.insert(0, args.kupfer_path)
+        sys.path.insert(0, REPO_DIR)
+        try:
+            import builtins
+        except ImportError:
+            import __builtin__ as builtins
+        if not hasattr(builtins, '_'):
+            builtins._ = lambda text: text
+        import hamster
+        results = {
+            'activities_used': args.used,
+            'activity_index': dict((size, benchmark_index(hamster, size, args.used, args.repeat))
+                                   for size in (int(size) for size in args.sizes.split(','))),
+            'fact_leaves': benchmark_fact_leaves(hamster, args.fact_leaves),
+        }
+    finally:
+        daemon.terminate()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    report = {
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'results': results,
+    }
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
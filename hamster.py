@@ -3,17 +3,31 @@ __description__ = _("Control the Hamster time tracker")
 __version__ = "2017.03.06"
 __author__ = "Jeroen Budts"
 __kupfer_actions__ = ("Toggle", "StartActivity", "StartActivityWithTags", "StartActivityWithDescription",
-                      "Overview", "Statistics", "Preferences",)
+                      "Overview", "Statistics", "Preferences", "ShowFacts", "ExportFacts",)
 __kupfer_sources__ = ("HamsterSource", )
+__kupfer_text_sources__ = ("ActivityMatchSource", "FactSearchSource", )
 
 import dbus
 
-from kupfer.objects import Action, AppLeaf, Source, Leaf, RunnableLeaf, SourceLeaf, TextLeaf
+from kupfer.objects import Action, AppLeaf, Source, Leaf, RunnableLeaf, SourceLeaf, TextLeaf, TextSource
+from kupfer.objects import FileLeaf
 from kupfer import pretty, plugin_support, icons, uiutils
 from kupfer.obj.apps import AppLeafContentMixin
 from kupfer.objects import OperationError
-from kupfer.weaklib import dbus_signal_connect_weakly
-from kupfer import utils
+from kupfer.weaklib import dbus_signal_connect_weakly, WeakCallback
+from kupfer import config, scheduler, utils
+import bisect
+import calendar
+import csv
+import datetime
+import functools
+import heapq
+import itertools
+import json
+import os
+import pickle
+import re
+import sqlite3
 import time
 
 __kupfer_settings__ = plugin_support.PluginSettings(
@@ -23,30 +37,358 @@ __kupfer_settings__ = plugin_support.PluginSettings(
         "type": bool,
         "value": True,
     },
+    {
+        "key": "toplevel_activities_count",
+        "label": _("Number of most used activities to include in top level (0 for all)"),
+        "type": int,
+        "value": 25,
+    },
     {
         "key": "return_started_facts",
         "label": _("When starting an activity immediately re-open Kupfer with the new activity focused. "
                    "This will let you easily further modify the start and endtime, tags and description."),
         "type": bool,
         "value": True,
+    },
+    {
+        "key": "async_actions",
+        "label": _("Do not wait for Hamster when starting, stopping or editing activities"),
+        "type": bool,
+        "value": True,
+    },
+    {
+        "key": "read_database",
+        "label": _("Read activities, tags and facts directly from the Hamster database"),
+        "type": bool,
+        "value": False,
+    },
+    {
+        "key": "facts_changed_delay",
+        "label": _("Wait this many milliseconds for more changes before refreshing the catalog"),
+        "type": int,
+        "value": 500,
     }
 )
 
 HAMSTER_APPNAMES = ("hamster-indicator", "hamster-time-tracker", )
+HAMSTER_BUS_NAME = 'org.gnome.Hamster'
+HAMSTER_OBJECT_PATH = '/org/gnome/Hamster'
+HAMSTER_INTERFACE = 'org.gnome.Hamster'
 
 plugin_support.check_dbus_connection()
 
 
+class HamsterClient (object):
+    '''Long-lived connection to the Hamster daemon.
+
+    The proxy is created once, without introspection, and follows the
+    well-known name across daemon restarts. Whether the daemon is running is
+    tracked through NameOwnerChanged, so checking availability never touches
+    the bus.'''
+    def __init__(self):
+        self._bus = None
+        self._interface = None
+        self._owner = None
+        self._watch = None
+        self._callbacks = []
+
+    def connect(self, callback):
+        '''Call `callback` whenever Hamster appears on the bus'''
+        self._callbacks.append(callback)
+
+    def _connect(self):
+        if self._bus is not None:
+            return
+        self._bus = dbus.SessionBus()
+        if self._bus.name_has_owner(HAMSTER_BUS_NAME):
+            self._owner = self._bus.get_name_owner(HAMSTER_BUS_NAME)
+        self._watch = self._bus.watch_name_owner(HAMSTER_BUS_NAME, self._name_owner_changed)
+
+    def _name_owner_changed(self, owner):
+        pretty.print_debug(__name__, "hamster owner changed: %r" % owner)
+        self._owner = owner or None
+        if self._owner:
+            for callback in self._callbacks:
+                callback()
+
+    @property
+    def bus(self):
+        self._connect()
+        return self._bus
+
+    @property
+    def is_available(self):
+        try:
+            self._connect()
+        except dbus.exceptions.DBusException as err:
+            pretty.print_debug(__name__, err)
+            return False
+        return self._owner is not None
+
+    @property
+    def interface(self):
+        if self._interface is None:
+            dbusObj = self.bus.get_object(HAMSTER_BUS_NAME, HAMSTER_OBJECT_PATH,
+                                          introspect=False, follow_name_owner_changes=True)
+            self._interface = dbus.Interface(dbusObj, dbus_interface=HAMSTER_INTERFACE)
+        return self._interface
+
+
+hamster_client = HamsterClient()
+
+
 def get_hamster():
+    if not hamster_client.is_available:
+        return None
     try:
-        bus = dbus.SessionBus()
-        dbusObj = bus.get_object('org.gnome.Hamster', '/org/gnome/Hamster')
-        return dbus.Interface(dbusObj, dbus_interface='org.gnome.Hamster')
+        return hamster_client.interface
     except dbus.exceptions.DBusException as err:
-        pretty.print_debug(err)
+        pretty.print_debug(__name__, err)
     return None
 
 
+def show_error(err):
+    pretty.print_error(__name__, err)
+    uiutils.show_notification(_("Hamster"), str(err), 'dialog-error')
+
+
+class CommandJournal (object):
+    '''Tracking commands given while Hamster was not running.
+
+    Commands are appended to a file, one JSON list per line, together with
+    the timestamps they were given at. When Hamster appears on the bus they
+    are replayed in order, each one waiting for the previous reply, and the
+    journal is removed once all of them were sent. A command Hamster rejects
+    is dropped and reported; when Hamster goes away during the replay, the
+    rest is kept for the next one.
+
+    UpdateFact replaces a fact with a new one, so the ids of the replaced
+    facts are mapped to the new ids and the commands that follow are sent
+    with those.'''
+    METHODS = ('AddFact', 'StopTracking', 'UpdateFact')
+    # errors that mean Hamster is gone, not that it rejected the command
+    UNREACHABLE_ERRORS = ('org.freedesktop.DBus.Error.ServiceUnknown',
+                          'org.freedesktop.DBus.Error.NameHasNoOwner',
+                          'org.freedesktop.DBus.Error.NoReply',
+                          'org.freedesktop.DBus.Error.Disconnected',
+                          'org.freedesktop.DBus.Error.Timeout')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.replay_filename = filename + '.replay'
+        self._pending = None
+        self._timer = scheduler.Timer()
+        # ids of facts replaced by replayed UpdateFacts, old id to new id
+        self._fact_ids = {}
+
+    def replay_later(self):
+        # give the proxy and a freshly started Hamster a moment to settle
+        self._timer.set(1, self.replay)
+
+    def append(self, method, args):
+        pretty.print_debug(__name__, "Journaling %s%r" % (method, args))
+        with open(self.filename, 'a') as journal:
+            journal.write(json.dumps([method] + list(args)) + '\n')
+
+    @property
+    def is_busy(self):
+        '''Whether commands are waiting to be replayed; new commands have to
+        queue up behind them'''
+        return (self._pending is not None or os.path.exists(self.filename) or
+                os.path.exists(self.replay_filename))
+
+    def get_fact_id(self, fact_id):
+        '''The id that the fact `fact_id` got from replayed edits'''
+        while fact_id in self._fact_ids:
+            fact_id = self._fact_ids[fact_id]
+        return fact_id
+
+    def _resolve(self, command):
+        if command[0] == 'UpdateFact':
+            return [command[0], self.get_fact_id(command[1])] + list(command[2:])
+        return command
+
+    def _read(self, filename):
+        commands = []
+        try:
+            with open(filename) as journal:
+                for line in journal:
+                    try:
+                        command = json.loads(line)
+                    except ValueError:
+                        # a line cut short when Kupfer was killed while writing
+                        pretty.print_error(__name__, "Skipping corrupt journal entry:", line)
+                        continue
+                    commands.append(command)
+        except (IOError, OSError):
+            pass
+        return commands
+
+    def _write(self, commands):
+        with open(self.filename, 'w') as journal:
+            for command in commands:
+                journal.write(json.dumps(command) + '\n')
+
+    def replay(self):
+        hamster = get_hamster()
+        if hamster is None or self._pending is not None:
+            return
+        if os.path.exists(self.filename):
+            # commands given while replaying go to a new journal; a replay
+            # file left behind by an interrupted replay comes first
+            commands = self._read(self.replay_filename) + self._read(self.filename)
+            with open(self.replay_filename, 'w') as journal:
+                for command in commands:
+                    journal.write(json.dumps(command) + '\n')
+            os.unlink(self.filename)
+        self._pending = self._read(self.replay_filename)
+        if not self._pending:
+            self._finish()
+            return
+        pretty.print_debug(__name__, "Replaying %d journaled commands" % len(self._pending))
+        self._replay_next()
+
+    def _replay_next(self, *reply):
+        if not self._pending:
+            self._finish()
+            if os.path.exists(self.filename):
+                # commands journaled while replaying
+                self.replay()
+            return
+        command = self._resolve(self._pending[0])
+        hamster = get_hamster()
+        if hamster is None:
+            self._abort(_("Hamster is not running"))
+            return
+        getattr(hamster, command[0])(*command[1:], reply_handler=self._replayed,
+                                     error_handler=self._failed)
+
+    def _replayed(self, *reply):
+        command = self._resolve(self._pending.pop(0))
+        if command[0] == 'UpdateFact' and reply:
+            self._fact_ids[command[1]] = int(reply[0])
+        self._replay_next()
+
+    def _failed(self, err):
+        get_dbus_name = getattr(err, 'get_dbus_name', None)
+        if not hamster_client.is_available or (get_dbus_name and get_dbus_name() in self.UNREACHABLE_ERRORS):
+            self._abort(err)
+            return
+        # retrying would fail the same way and hold up every later command
+        command = self._pending.pop(0)
+        pretty.print_error(__name__, "Hamster rejected journaled command %r:" % (command,), err)
+        show_error(_("Hamster rejected a command given while it was not running: %s") % err)
+        self._replay_next()
+
+    def _finish(self):
+        self._pending = None
+        try:
+            os.unlink(self.replay_filename)
+        except OSError:
+            pass
+
+    def _abort(self, err):
+        pretty.print_error(__name__, "Replaying journal failed:", err)
+        self._write([self._resolve(command) for command in self._pending + self._read(self.filename)])
+        self._finish()
+
+
+command_journal = CommandJournal(config.save_data_file('hamster-journal'))
+hamster_client.connect(command_journal.replay_later)
+
+
+def call_hamster(method, *args, **kwargs):
+    '''Call `method` on the Hamster daemon.
+
+    When asynchronous actions are enabled the call returns immediately and
+    the result is passed to `reply_handler` once Hamster answers; errors are
+    shown as a notification instead of stalling Kupfer. Otherwise the call
+    blocks and its result is returned.
+
+    Tracking commands given while Hamster is not running are journaled and
+    sent when it is back; they have no result. Until the journal has been
+    replayed, new tracking commands are journaled behind it so they keep
+    their order.'''
+    hamster = get_hamster()
+    if hamster is None:
+        if method not in CommandJournal.METHODS:
+            raise OperationError(_("Hamster is not running"))
+        command_journal.append(method, args)
+        return None
+    if method in ('UpdateFact', 'RemoveFact'):
+        # the leaf may still have the id of a fact a replayed edit replaced
+        args = (command_journal.get_fact_id(args[0]),) + args[1:]
+    if method in CommandJournal.METHODS and command_journal.is_busy:
+        command_journal.append(method, args)
+        command_journal.replay_later()
+        return None
+    if not __kupfer_settings__["async_actions"]:
+        return getattr(hamster, method)(*args)
+    reply_handler = kwargs.get('reply_handler') or (lambda *reply: None)
+    start = time.time()
+    getattr(hamster, method)(*args, reply_handler=reply_handler, error_handler=show_error)
+    pretty.print_debug(__name__, "%s dispatched, blocked for %.1fms" % (method, (time.time() - start) * 1000))
+
+
+def get_fact_string(leaf, description=None):
+    '''The fact string that starts `leaf` again, optionally with another
+    description'''
+    if isinstance(leaf, FactLeaf):
+        return format_fact_string(leaf.activity, leaf.category, description or leaf.description, leaf.tags)
+    if description:
+        return leaf.object + ', ' + description
+    return leaf.object
+
+
+def make_started_fact_leaf(fact_id, fact, starttime):
+    '''Return a FactLeaf for the fact Hamster just stored from the string
+    `fact`, built from what was sent instead of asking Hamster for it.
+
+    The stored fact is fetched in the background and replaces the local
+    one, unless the leaf has been edited in the meantime.'''
+    activity, category, description, tags = parse_fact_string(fact)
+    day = get_fact_day(starttime)
+    local_fact = (fact_id, starttime, 0, description, activity, 0, category, tags,
+                  calendar.timegm(day.timetuple()), 0)
+    leaf = FactLeaf(local_fact)
+
+    def fact_fetched(stored_fact):
+        if leaf.fact is not local_fact:
+            return
+        if pretty.debug and tuple(stored_fact)[:8] != local_fact[:8]:
+            pretty.print_debug(__name__, "Hamster stored fact %d as %r" % (fact_id, stored_fact))
+        leaf.fact = stored_fact
+        leaf._description = None
+
+    # never wait for this one, whatever async_actions says
+    hamster = get_hamster()
+    if hamster is not None:
+        hamster.GetFact(fact_id, reply_handler=fact_fetched, error_handler=show_error)
+    return leaf
+
+
+def start_fact(fact, ctx):
+    '''Start tracking `fact` and return its FactLeaf if that is wanted.
+
+    In asynchronous mode the leaf is handed to Kupfer through `ctx` as soon
+    as Hamster has stored the fact.'''
+    pretty.print_debug(__name__, "Adding fact: " + fact)
+    activity_usage.record(fact.split(',', 1)[0].strip())
+    return_fact = __kupfer_settings__["return_started_facts"]
+    starttime = get_timestamp()
+    if not __kupfer_settings__["async_actions"]:
+        fact_id = call_hamster('AddFact', fact, starttime, 0, False)
+        if return_fact and fact_id is not None:
+            return make_started_fact_leaf(fact_id, fact, starttime)
+        return None
+
+    def fact_added(fact_id):
+        if return_fact:
+            ctx.register_late_result(make_started_fact_leaf(fact_id, fact, starttime))
+
+    call_hamster('AddFact', fact, starttime, 0, False, reply_handler=fact_added)
+
+
 def format_duration(seconds):
     hours, remainder = divmod(seconds, 3600)
     minutes, seconds = divmod(remainder, 60)
@@ -75,14 +417,41 @@ def format_fact_string(activity, category=None, description=None, tags=None):
     return fact
 
 
-def parse_time(timestr):
+def parse_fact_string(fact):
+    '''Split a fact string as made by format_fact_string into its activity,
+    category, description and tags'''
+    activity, _sep, details = fact.partition(',')
+    activity, _sep, category = activity.partition('@')
+    words = details.split()
+    tags = []
+    while words and words[-1].startswith('#') and len(words[-1]) > 1:
+        tags.insert(0, words.pop()[1:])
+    return activity.strip(), category.strip(), ' '.join(words), tags
+
+
+def parse_time(timestr, reference=None):
+    '''Parse "hh:mm" into a timestamp on the same day as the `reference`
+    timestamp, or on the current day'''
     parsed = time.strptime(timestr, "%H:%M")
+    if reference is not None:
+        day = time.gmtime(reference)
+        return calendar.timegm((day.tm_year, day.tm_mon, day.tm_mday, parsed.tm_hour, parsed.tm_min,
+                                0, 0, 0, 0))
     now = time.localtime()
     result = time.struct_time((now.tm_year, now.tm_mon, now.tm_mday, parsed.tm_hour, parsed.tm_min,
                                0, now.tm_wday, now.tm_yday, now.tm_isdst))
     return get_timestamp(result)
 
 
+def parse_end_time(timestr, starttime):
+    '''Parse "hh:mm" into the first timestamp at that time after the
+    `starttime` timestamp, so an end before the start is on the next day'''
+    endtime = parse_time(timestr, starttime)
+    if endtime < starttime:
+        endtime += 24 * 3600
+    return endtime
+
+
 def get_timestamp(time_struct=None):
     if not time_struct:
         time_struct = time.gmtime()
@@ -93,7 +462,976 @@ def get_timestamp(time_struct=None):
         secs -= time.altzone
     else:
         secs -= time.timezone
-    return secs
+    return int(secs)
+
+
+FACT_EDIT_TIMES = re.compile(r'\s*(\d{1,2}:\d{2})?\s*(?:-\s*(\d{1,2}:\d{2}))?')
+
+
+def parse_fact_edit(text):
+    '''Parse "[hh:mm][-hh:mm] [#tag ...][, description]" into a dict of the
+    fact fields to change. Raises ValueError if the text does not match.'''
+    head, separator, description = text.partition(',')
+    match = FACT_EDIT_TIMES.match(head)
+    start, end = match.groups()
+    words = head[match.end():].split()
+    tags = [word[1:] for word in words if word.startswith('#') and len(word) > 1]
+    if len(tags) != len(words):
+        raise ValueError(text)
+    changes = {}
+    if start:
+        time.strptime(start, "%H:%M")
+        changes['start'] = start
+    if end:
+        time.strptime(end, "%H:%M")
+        changes['end'] = end
+    if tags:
+        changes['tags'] = tags
+    if separator:
+        changes['description'] = description.strip()
+    if not changes:
+        raise ValueError(text)
+    return changes
+
+
+def get_fact_day(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).date()
+
+
+def started_on(fact, day):
+    '''Whether `fact` started on `day`; Hamster also returns the facts that
+    run into a day from the day before'''
+    return get_fact_day(fact[1]) == day
+
+
+def parse_date_range(text):
+    '''Parse "yyyy-mm-dd" or "yyyy-mm-dd..yyyy-mm-dd" into the first and
+    last day of the range. Raises ValueError for anything else.'''
+    parts = text.split('..')
+    if len(parts) > 2:
+        raise ValueError(text)
+    days = sorted(datetime.datetime.strptime(part.strip(), '%Y-%m-%d').date() for part in parts)
+    return days[0], days[-1]
+
+
+def format_activity(activity, category):
+    activity = str(activity)
+    if category:
+        activity += '@' + str(category)
+    return activity
+
+
+def get_cache_filename(name):
+    return os.path.join(config.get_cache_home(), name)
+
+
+def load_cache(filename, version):
+    '''Return the data stored in `filename` by save_cache, or None.
+
+    A cache written with another version or that can not be unpickled is
+    removed, so it will be rebuilt from scratch.'''
+    try:
+        with open(filename, 'rb') as cache:
+            cache_version, data = pickle.load(cache)
+    except (IOError, OSError):
+        return None
+    except Exception as err:
+        pretty.print_error(__name__, "Discarding corrupt cache %s:" % filename, err)
+        discard_cache(filename)
+        return None
+    if cache_version != version:
+        pretty.print_debug(__name__, "Discarding cache %s version %r" % (filename, cache_version))
+        discard_cache(filename)
+        return None
+    return data
+
+
+def save_cache(filename, version, data):
+    tmpname = filename + '.tmp'
+    try:
+        with open(tmpname, 'wb') as cache:
+            pickle.dump((version, data), cache, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpname, filename)
+    except (IOError, OSError) as err:
+        pretty.print_error(__name__, "Could not save cache %s:" % filename, err)
+
+
+def discard_cache(filename):
+    try:
+        os.unlink(filename)
+    except OSError:
+        pass
+
+
+HAMSTER_DATABASE_VERSIONS = (9, )
+
+
+def get_hamster_database_filenames():
+    data_home = os.environ.get('XDG_DATA_HOME') or os.path.expanduser('~/.local/share')
+    return [os.path.join(data_home, 'hamster-applet', 'hamster.db'),
+            os.path.join(data_home, 'hamster', 'hamster.db')]
+
+
+def parse_database_time(value):
+    if not value:
+        return 0
+    return calendar.timegm(time.strptime(str(value)[:19], '%Y-%m-%d %H:%M:%S'))
+
+
+class HamsterDatabase (object):
+    '''Read-only access to the SQLite database of Hamster.
+
+    Catalog queries are answered straight from the database, which avoids
+    marshalling large results over D-Bus; all changes still go through
+    D-Bus. When the database is missing, has a schema version this plugin
+    does not know or a query fails, the queries return None and the plugin
+    falls back to D-Bus.'''
+    def __init__(self, filenames):
+        self.filenames = filenames
+        self._connection = None
+        self._failed = False
+
+    def _connect(self):
+        if self._connection is None and not self._failed:
+            self._connection = self._open()
+            self._failed = self._connection is None
+        return self._connection
+
+    def _open(self):
+        for filename in self.filenames:
+            if not os.path.exists(filename):
+                continue
+            try:
+                try:
+                    # read only, so Hamster's writes (and its WAL) are never touched
+                    connection = sqlite3.connect('file:%s?mode=ro' % filename, uri=True)
+                except TypeError:
+                    connection = sqlite3.connect(filename)
+                    connection.execute('PRAGMA query_only = ON')
+                version = connection.execute('SELECT version FROM version').fetchone()[0]
+            except sqlite3.Error as err:
+                pretty.print_error(__name__, "Could not open Hamster database %s:" % filename, err)
+                continue
+            if version not in HAMSTER_DATABASE_VERSIONS:
+                pretty.print_debug(__name__, "Unknown Hamster database version %r, using D-Bus" % version)
+                connection.close()
+                continue
+            pretty.print_debug(__name__, "Reading from Hamster database " + filename)
+            return connection
+        return None
+
+    def _query(self, sql, args=()):
+        if not __kupfer_settings__["read_database"]:
+            return None
+        connection = self._connect()
+        if connection is None:
+            return None
+        try:
+            return connection.execute(sql, args).fetchall()
+        except sqlite3.Error as err:
+            pretty.print_error(__name__, "Hamster database query failed, using D-Bus:", err)
+            connection.close()
+            self._connection = None
+            self._failed = True
+            return None
+
+    def get_activities(self):
+        return self._query("SELECT a.name, COALESCE(c.name, '') FROM activities a "
+                           "LEFT JOIN categories c ON c.id = a.category_id "
+                           "WHERE a.deleted IS NULL ORDER BY lower(a.name)")
+
+    def get_tags(self):
+        return self._query("SELECT id, name, autocomplete FROM tags "
+                           "WHERE autocomplete != 'false' ORDER BY name")
+
+    def get_facts(self, day):
+        '''Facts that started on `day`, in the same form as over D-Bus'''
+        following = day + datetime.timedelta(days=1)
+        rows = self._query("SELECT f.id, f.start_time, f.end_time, f.description, a.name, a.id, "
+                           "COALESCE(c.name, ''), "
+                           "(SELECT group_concat(t.name, ',') FROM fact_tags ft "
+                           " JOIN tags t ON t.id = ft.tag_id WHERE ft.fact_id = f.id) "
+                           "FROM facts f JOIN activities a ON a.id = f.activity_id "
+                           "LEFT JOIN categories c ON c.id = a.category_id "
+                           "WHERE f.start_time >= ? AND f.start_time < ? ORDER BY f.start_time",
+                           (day.isoformat(), following.isoformat()))
+        if rows is None:
+            return None
+        date = calendar.timegm(day.timetuple())
+        facts = []
+        for fact_id, start, end, description, activity, activity_id, category, tags in rows:
+            start = parse_database_time(start)
+            end = parse_database_time(end)
+            facts.append((fact_id, start, end, description or '', activity, activity_id, category,
+                          tags.split(',') if tags else [], date, end - start if end else 0))
+        return facts
+
+
+hamster_database = HamsterDatabase(get_hamster_database_filenames())
+
+
+class ActivityCatalog (object):
+    '''All activities known to Hamster, cached on disk between sessions.
+
+    The cached list is available immediately at startup. A refresh queries
+    Hamster in the background and only applies the activities that were
+    added or removed since the last time; listeners are only notified when
+    something actually changed.'''
+    VERSION = 1
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.activities = []
+        self._callbacks = []
+        self._refreshing = False
+        self._load()
+
+    def connect(self, callback):
+        self._callbacks.append(WeakCallback(callback))
+
+    def _load(self):
+        activities = load_cache(self.filename, self.VERSION)
+        if isinstance(activities, list):
+            self.activities = activities
+            pretty.print_debug(__name__, "Loaded %d cached activities" % len(activities))
+
+    def _save(self):
+        save_cache(self.filename, self.VERSION, self.activities)
+
+    def refresh(self):
+        activities = hamster_database.get_activities()
+        if activities is not None:
+            self._activities_received(activities)
+            return
+        hamster = get_hamster()
+        if hamster is None or self._refreshing:
+            return
+        self._refreshing = True
+        hamster.GetActivities('', reply_handler=self._activities_received,
+                              error_handler=self._refresh_failed)
+
+    def _refresh_failed(self, err):
+        self._refreshing = False
+        pretty.print_error(__name__, "Could not fetch activities:", err)
+
+    def _activities_received(self, activities):
+        self._refreshing = False
+        current = [format_activity(act[0], act[1]) for act in activities]
+        current_set = set(current)
+        known_set = set(self.activities)
+        removed = known_set - current_set
+        added = [act for act in current if act not in known_set]
+        if not removed and not added:
+            return
+        pretty.print_debug(__name__, "Activities changed: %d added, %d removed" % (len(added), len(removed)))
+        if removed:
+            self.activities = [act for act in self.activities if act not in removed]
+        self.activities.extend(added)
+        self._save()
+        for callback in self._callbacks:
+            callback()
+
+
+class ActivityUsage (object):
+    '''How often and how recently each activity was started from Kupfer'''
+    VERSION = 1
+    # the weight of a start halves every two weeks
+    HALF_LIFE = 14 * 24 * 3600
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.usage = load_cache(filename, self.VERSION) or {}
+
+    def record(self, activity):
+        count, last_used = self.usage.get(activity, (0, 0))
+        self.usage[activity] = (count + 1, time.time())
+        save_cache(self.filename, self.VERSION, self.usage)
+
+    def score(self, activity, now=None):
+        count, last_used = self.usage.get(activity, (0, 0))
+        if not count:
+            return 0.0
+        age = (now or time.time()) - last_used
+        return count * 0.5 ** (age / float(self.HALF_LIFE))
+
+    def most_used(self, activities, count, now=None):
+        now = now or time.time()
+        return heapq.nlargest(count, activities, key=lambda act: self.score(act, now))
+
+
+class ActivityIndex (object):
+    '''Prefix and trigram index over the activity catalog.
+
+    Queries of one or two characters are answered from the word prefixes,
+    longer queries from the shortest trigram posting list. Results are
+    ranked by whether they start with the query and then by frecency. Only
+    activities that were ever started have a frecency, so those are ranked
+    explicitly and the rest is filled from the posting list, stopping as
+    soon as enough activities starting with the query have been found.'''
+    WORD_SEPARATORS = re.compile(r'[\s@,._-]+')
+
+    def __init__(self, catalog, usage):
+        self.catalog = catalog
+        self.usage = usage
+        self._activities = None
+        catalog.connect(self.invalidate)
+
+    def invalidate(self):
+        self._activities = None
+
+    def _build(self):
+        self._activities = list(self.catalog.activities)
+        self._lowered = [act.lower() for act in self._activities]
+        self._prefixes = {}
+        self._trigrams = {}
+        for i, text in enumerate(self._lowered):
+            prefixes = set()
+            for word in self.WORD_SEPARATORS.split(text):
+                prefixes.update((word[:1], word[:2]))
+            prefixes.discard('')
+            for prefix in prefixes:
+                self._prefixes.setdefault(prefix, []).append(i)
+            for trigram in set(text[j:j + 3] for j in range(len(text) - 2)):
+                self._trigrams.setdefault(trigram, []).append(i)
+
+    def _candidates(self, text):
+        if len(text) < 3:
+            return self._prefixes.get(text, ())
+        postings = [self._trigrams.get(text[j:j + 3], ()) for j in range(len(text) - 2)]
+        return min(postings, key=len)
+
+    def query(self, text, limit):
+        if self._activities is None:
+            self._build()
+        text = text.strip().lower()
+        if not text:
+            return []
+        now = time.time()
+        used = [act for act in self.usage.usage if text in act.lower()]
+        ranked = heapq.nlargest(limit, used, key=lambda act: (act.lower().startswith(text),
+                                                              self.usage.score(act, now)))
+        seen = set(ranked)
+        starting = []
+        containing = []
+        for i in self._candidates(text):
+            lowered = self._lowered[i]
+            if lowered.startswith(text):
+                starting.append(i)
+                if len(starting) == limit:
+                    break
+            elif len(containing) < limit and text in lowered:
+                containing.append(i)
+        ranked_starting = [act for act in ranked if act.lower().startswith(text)]
+        ranked_containing = ranked[len(ranked_starting):]
+        result = ranked_starting
+        result.extend(self._activities[i] for i in starting if self._activities[i] not in seen)
+        result.extend(ranked_containing)
+        result.extend(self._activities[i] for i in containing if self._activities[i] not in seen)
+        return result[:limit]
+
+
+class TagCache (object):
+    '''The tags known to Hamster and the tags used with each activity.
+
+    The tag list is fetched once and kept until Hamster reports that tags or
+    facts changed. The tags per activity are collected from the facts the
+    plugin fetches anyway, so ranking them needs no extra queries.'''
+    def __init__(self):
+        self.tags = None
+        self._activity_facts = {}
+
+    def initialize(self):
+        dbus_signal_connect_weakly(hamster_client.bus, 'TagsChanged', self.invalidate,
+                                   dbus_interface=HAMSTER_INTERFACE)
+
+    def invalidate(self, *args):
+        self.tags = None
+
+    def get_tags(self):
+        if self.tags is None:
+            tags = hamster_database.get_tags()
+            if tags is None:
+                tags = get_hamster().GetTags(True)
+            self.tags = [str(t[1]) for t in tags]
+        return self.tags
+
+    def add_facts(self, facts):
+        for fact in facts:
+            if fact[7]:
+                activity = format_activity(fact[4], fact[6])
+                self._activity_facts.setdefault(activity, {})[fact[0]] = [str(t) for t in fact[7]]
+
+    def forget_fact(self, activity, fact_id):
+        self._activity_facts.get(activity, {}).pop(fact_id, None)
+
+    def get_tag_counts(self, activity):
+        counts = {}
+        for tags in self._activity_facts.get(activity, {}).values():
+            for tag in tags:
+                counts[tag] = counts.get(tag, 0) + 1
+        return counts
+
+
+def fetch_facts(day):
+    facts = hamster_database.get_facts(day)
+    if facts is not None:
+        return facts
+    hamster = get_hamster()
+    if hamster is None:
+        raise OperationError(_("Hamster is not running"))
+    if day == datetime.date.today():
+        return hamster.GetTodaysFacts()
+    timestamp = calendar.timegm(day.timetuple())
+    return hamster.GetFacts(dbus.UInt32(timestamp), dbus.UInt32(timestamp), '')
+
+
+def fetch_facts_async(day, reply_handler, error_handler):
+    '''Like fetch_facts, but pass the facts to `reply_handler` instead of
+    waiting for Hamster to answer'''
+    facts = hamster_database.get_facts(day)
+    if facts is not None:
+        reply_handler(facts)
+        return
+    hamster = get_hamster()
+    if hamster is None:
+        error_handler(OperationError(_("Hamster is not running")))
+        return
+    try:
+        if day == datetime.date.today():
+            hamster.GetTodaysFacts(reply_handler=reply_handler, error_handler=error_handler)
+        else:
+            timestamp = calendar.timegm(day.timetuple())
+            hamster.GetFacts(dbus.UInt32(timestamp), dbus.UInt32(timestamp), '',
+                             reply_handler=reply_handler, error_handler=error_handler)
+    except dbus.exceptions.DBusException as err:
+        error_handler(err)
+
+
+class FactsCache (object):
+    '''Facts per day, fetched from Hamster one day at a time.
+
+    Past days do not change through normal tracking, so they are kept until
+    one of their facts is edited from Kupfer. Only today (and yesterday, for
+    activities running past midnight) are dropped when Hamster reports that
+    facts changed.'''
+    def __init__(self):
+        self._days = {}
+
+    def get_facts(self, day):
+        if day not in self._days:
+            facts = fetch_facts(day)
+            pretty.print_debug(__name__, "Fetched %d facts for %s" % (len(facts), day))
+            tag_cache.add_facts(facts)
+            self._days[day] = facts
+        return self._days[day]
+
+    def invalidate(self, day):
+        self._days.pop(day, None)
+        statistics_cache.invalidate(day)
+        fact_index.invalidate(day)
+
+    def invalidate_recent(self):
+        today = datetime.date.today()
+        for day in list(self._days):
+            if day >= today - datetime.timedelta(days=1):
+                del self._days[day]
+        statistics_cache.invalidate(today - datetime.timedelta(days=1))
+        fact_index.invalidate(today - datetime.timedelta(days=1))
+
+
+class DailyTotals (object):
+    '''Running totals of the time tracked today.
+
+    The totals of finished facts are recomputed in the background after
+    Hamster reports that facts changed. The time of the running activity is
+    added from the clock when the totals are read, so reading them does not
+    need Hamster.'''
+    def __init__(self):
+        self.day = None
+        self.closed_total = 0
+        self.closed_categories = {}
+        self.current = None
+
+    def refresh(self):
+        hamster = get_hamster()
+        if hamster is None:
+            return
+        day = datetime.date.today()
+        hamster.GetTodaysFacts(reply_handler=lambda facts: self.update(day, facts),
+                               error_handler=show_error)
+
+    def update(self, day, facts):
+        total = 0
+        categories = {}
+        current = None
+        for fact in facts:
+            if fact[2] == 0:
+                current = fact
+                continue
+            duration = fact[2] - fact[1]
+            total += duration
+            categories[fact[6]] = categories.get(fact[6], 0) + duration
+        tag_cache.add_facts(facts)
+        self.day = day
+        self.closed_total = total
+        self.closed_categories = categories
+        self.current = current
+
+    def ensure_current(self):
+        '''Fetch the totals if they are missing or from another day'''
+        today = datetime.date.today()
+        if self.day != today:
+            self.update(today, get_hamster().GetTodaysFacts())
+
+    def get_total(self, now):
+        if self.current is None:
+            return self.closed_total
+        return self.closed_total + now - self.current[1]
+
+    def get_categories(self, now):
+        categories = dict(self.closed_categories)
+        if self.current is not None:
+            category = self.current[6]
+            categories[category] = categories.get(category, 0) + now - self.current[1]
+        return categories
+
+
+def aggregate_facts(facts, now):
+    '''Return the time tracked per activity, per category and per tag in
+    `facts`, counting a running fact until `now`'''
+    activities = {}
+    categories = {}
+    tags = {}
+    for fact in facts:
+        duration = (fact[2] or now) - fact[1]
+        activity = format_activity(fact[4], fact[6])
+        activities[activity] = activities.get(activity, 0) + duration
+        category = str(fact[6])
+        categories[category] = categories.get(category, 0) + duration
+        for tag in fact[7]:
+            tag = str(tag)
+            tags[tag] = tags.get(tag, 0) + duration
+    return activities, categories, tags
+
+
+def combine_totals(target, totals):
+    for key, duration in totals.items():
+        target[key] = target.get(key, 0) + duration
+
+
+class StatisticsCache (object):
+    '''Totals per activity, category and tag for each day.
+
+    Days before today are aggregated once and the totals are kept on disk,
+    so the statistics of a period only sum the facts of today with them.
+    Days that are not aggregated yet are fetched in the background, one day
+    per idle iteration, the way the fact index is built. A past day is
+    aggregated again after its facts changed.
+
+    Every fact is counted on the day it started; a fact that is still
+    running is counted with today.'''
+    VERSION = 2
+    SAVE_EVERY_DAYS = 100
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._days = None
+        self._invalidated = set()
+        self._timer = scheduler.Timer()
+        self._updating = False
+        self._unsaved_days = 0
+        # (first, last, callback) for every period waiting for its days
+        self._wanted = []
+
+    def _load(self):
+        if self._days is None:
+            self._days = load_cache(self.filename, self.VERSION) or {}
+
+    def _drop_invalidated(self):
+        dropped = [day for day in self._invalidated if self._days.pop(day, None) is not None]
+        self._invalidated.clear()
+        return bool(dropped)
+
+    def invalidate(self, day):
+        # called whenever facts change, so the cache is not loaded here; the
+        # day is aggregated again when the totals are next read
+        self._invalidated.add(day)
+
+    def get_missing_days(self, first, last):
+        '''The days from `first` up to and including `last` that are not
+        aggregated yet'''
+        self._load()
+        if self._drop_invalidated():
+            self._save()
+        today = datetime.date.today()
+        missing = []
+        day = first
+        while day <= last and day < today:
+            if day not in self._days:
+                missing.append(day)
+            day += datetime.timedelta(days=1)
+        return missing
+
+    def update_later(self, first, last, callback):
+        '''Aggregate the missing days from `first` to `last` in the
+        background and call `callback` once all of them are'''
+        self._load()
+        self._wanted.append((first, last, callback))
+        if not self._updating:
+            self._updating = True
+            self._timer.set_idle(self._update_step)
+
+    def _save(self):
+        self._unsaved_days = 0
+        save_cache(self.filename, self.VERSION, self._days)
+
+    def _update_step(self):
+        while self._wanted:
+            first, last, callback = self._wanted[0]
+            missing = self.get_missing_days(first, last)
+            if missing:
+                break
+            self._wanted.pop(0)
+            callback()
+        else:
+            self._updating = False
+            if self._unsaved_days:
+                self._save()
+            return
+        day = missing[0]
+
+        def fetched(facts):
+            # running facts are counted with today
+            facts = [fact for fact in facts if started_on(fact, day) and fact[2]]
+            self._days[day] = aggregate_facts(facts, 0)
+            self._unsaved_days += 1
+            if self._unsaved_days >= self.SAVE_EVERY_DAYS:
+                self._save()
+            self._timer.set_idle(self._update_step)
+
+        def failed(err):
+            # Hamster is not running; the days are fetched when the
+            # statistics are shown again
+            pretty.print_debug(__name__, "Aggregating statistics interrupted:", err)
+            self._updating = False
+            self._wanted = []
+            if self._unsaved_days:
+                self._save()
+
+        fetch_facts_async(day, fetched, failed)
+
+    def get_totals(self, first, last):
+        '''Return the (activities, categories, tags) totals from `first` up
+        to and including `last`, leaving out the days that are not
+        aggregated yet'''
+        self._load()
+        today = datetime.date.today()
+        totals = ({}, {}, {})
+        day = first
+        while day <= last and day < today:
+            for target, day_totals in zip(totals, self._days.get(day, ())):
+                combine_totals(target, day_totals)
+            day += datetime.timedelta(days=1)
+        if first <= today <= last:
+            facts = [fact for fact in facts_cache.get_facts(today) if started_on(fact, today) or not fact[2]]
+            for target, day_totals in zip(totals, aggregate_facts(facts, get_timestamp())):
+                combine_totals(target, day_totals)
+        return totals
+
+
+FACT_WORDS = re.compile(r'\w+', re.UNICODE)
+
+
+def get_fact_words(fact):
+    '''The lowercase words of the description and the tags of `fact`'''
+    words = set(FACT_WORDS.findall(fact[3].lower()))
+    for tag in fact[7]:
+        words.update(FACT_WORDS.findall(tag.lower()))
+    return words
+
+
+class FactIndex (object):
+    '''Inverted index from the words in fact descriptions and tags to the
+    facts of all days before today.
+
+    The index is kept on disk and extended in the background: first with
+    the days that closed since it was last updated, then further back into
+    the history until a whole year without facts is found, one day per idle
+    iteration and without waiting for Hamster. Days whose facts were edited
+    are indexed again; their old facts are only dropped once the new ones
+    have arrived.'''
+    VERSION = 1
+    SAVE_EVERY_DAYS = 100
+    # this many days without any fact means the start of the history
+    EMPTY_DAYS_LIMIT = 366
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.facts = None
+        self._vocabulary = None
+        self._timer = scheduler.Timer()
+        self._updating = False
+        self._unsaved_days = 0
+        # days invalidated since the last update step, merged into `stale`
+        # once the index is loaded
+        self._invalidated = set()
+
+    def _load(self):
+        if self.facts is not None:
+            return
+        data = load_cache(self.filename, self.VERSION)
+        if data is None:
+            data = ({}, {}, {}, None, None, 0, set())
+        (self.facts, self.days, self.postings, self.newest, self.oldest,
+         self.empty_days, self.stale) = data
+
+    def _save(self):
+        self._unsaved_days = 0
+        save_cache(self.filename, self.VERSION, (self.facts, self.days, self.postings, self.newest,
+                                                 self.oldest, self.empty_days, self.stale))
+
+    def _remove_day(self, day):
+        for fact_id in self.days.pop(day, ()):
+            fact = self.facts.pop(fact_id, None)
+            if fact is None:
+                continue
+            for word in get_fact_words(fact):
+                fact_ids = self.postings[word]
+                fact_ids.discard(fact_id)
+                if not fact_ids:
+                    del self.postings[word]
+                    self._vocabulary = None
+
+    def _add_day(self, day, facts):
+        '''Replace the indexed facts of `day` with those of `facts` that
+        started on it'''
+        self._remove_day(day)
+        facts = [fact for fact in facts if started_on(fact, day)]
+        if not facts:
+            return
+        for fact in facts:
+            # plain values, the dbus types are not worth pickling
+            fact = (int(fact[0]), int(fact[1]), int(fact[2]), str(fact[3]), str(fact[4]), int(fact[5]),
+                    str(fact[6]), [str(tag) for tag in fact[7]], int(fact[8]), int(fact[9]))
+            self.facts[fact[0]] = fact
+            for word in get_fact_words(fact):
+                if word not in self.postings:
+                    self.postings[word] = set()
+                    self._vocabulary = None
+                self.postings[word].add(fact[0])
+        self.days[day] = [fact[0] for fact in facts]
+
+    def _next_day(self, yesterday):
+        '''Return the next day to index, or None when the index is complete'''
+        if self.stale:
+            return min(self.stale)
+        if self.newest is None:
+            return yesterday
+        if self.newest < yesterday:
+            return self.newest + datetime.timedelta(days=1)
+        if self.empty_days < self.EMPTY_DAYS_LIMIT:
+            return self.oldest - datetime.timedelta(days=1)
+        return None
+
+    def _day_fetched(self, day, facts):
+        self._add_day(day, facts)
+        if day in self.stale:
+            self.stale.discard(day)
+        elif self.newest is None:
+            self.newest = self.oldest = day
+            self.empty_days = 0 if facts else 1
+        elif day > self.newest:
+            self.newest = day
+        else:
+            self.oldest = day
+            self.empty_days = 0 if facts else self.empty_days + 1
+
+    def _merge_invalidated(self):
+        for day in self._invalidated:
+            if self.newest is not None and self.oldest <= day <= self.newest:
+                self.stale.add(day)
+        self._invalidated.clear()
+
+    def invalidate(self, day):
+        # called whenever facts change, so the index is not loaded here; the
+        # day is fetched again when the index is next used
+        self._invalidated.add(day)
+
+    def update_later(self):
+        self._load()
+        if not self._updating:
+            self._updating = True
+            self._timer.set(1, self._update_step)
+
+    def _update_step(self):
+        self._merge_invalidated()
+        day = self._next_day(datetime.date.today() - datetime.timedelta(days=1))
+        if day is None:
+            self._updating = False
+            if self._unsaved_days:
+                pretty.print_debug(__name__, "Fact index: %d facts, %d words, back to %s" %
+                                   (len(self.facts), len(self.postings), self.oldest))
+                self._save()
+            return
+        start = time.time()
+
+        def fetched(facts):
+            try:
+                self._day_fetched(day, facts)
+            except Exception as err:
+                # stop instead of leaving the update stuck; the day is
+                # tried again the next time the index is updated
+                pretty.print_error(__name__, "Could not index the facts of %s:" % day, err)
+                self._updating = False
+                return
+            self._unsaved_days += 1
+            if self._unsaved_days >= self.SAVE_EVERY_DAYS:
+                pretty.print_debug(__name__, "Fact index: back to %s, indexed %s in %.1fms" %
+                                   (self.oldest, day, (time.time() - start) * 1000))
+                self._save()
+            self._timer.set_idle(self._update_step)
+
+        def failed(err):
+            # Hamster is not running; continue when it returns. The day keeps
+            # its old facts until then.
+            pretty.print_debug(__name__, "Fact index update interrupted:", err)
+            self._updating = False
+            self._save()
+
+        fetch_facts_async(day, fetched, failed)
+
+    def _matching(self, word):
+        '''The ids of the facts with a word that starts with `word`'''
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self.postings)
+        matching = set()
+        position = bisect.bisect_left(self._vocabulary, word)
+        while position < len(self._vocabulary) and self._vocabulary[position].startswith(word):
+            matching.update(self.postings[self._vocabulary[position]])
+            position += 1
+        return matching
+
+    def query(self, text, limit):
+        '''Return the most recent facts whose description or tags have words
+        starting with every word of `text`; of facts that only differ in
+        their times, only the most recent is returned.'''
+        self._load()
+        self._merge_invalidated()
+        if (self.stale or self.newest is None or
+                self.newest < datetime.date.today() - datetime.timedelta(days=1)):
+            self.update_later()
+        words = FACT_WORDS.findall(text.lower())
+        if not words:
+            return []
+        candidates = None
+        for word in sorted(words, key=len, reverse=True):
+            matching = self._matching(word)
+            candidates = matching if candidates is None else candidates & matching
+            if not candidates:
+                return []
+        facts = []
+        seen = set()
+        for fact_id in sorted(candidates, key=lambda fact_id: self.facts[fact_id][1], reverse=True):
+            fact = self.facts[fact_id]
+            key = (fact[4], fact[6], fact[3], tuple(fact[7]))
+            if key in seen:
+                continue
+            seen.add(key)
+            facts.append(fact)
+            if len(facts) == limit:
+                break
+        return facts
+
+
+EXPORT_FIELDS = ('start', 'end', 'duration', 'activity', 'category', 'description', 'tags', 'fact')
+
+
+def iter_range_facts(first, last):
+    '''Yield the facts from `first` to `last`, fetching one day at a time
+    without caching them'''
+    # facts running past midnight are returned for both days
+    seen = set()
+    day = first
+    while day <= last:
+        for fact in fetch_facts(day):
+            if fact[0] not in seen:
+                seen.add(fact[0])
+                yield fact
+        day += datetime.timedelta(days=1)
+
+
+def format_export_time(seconds):
+    if not seconds:
+        return ''
+    return time.strftime("%Y-%m-%d %H:%M", time.gmtime(seconds))
+
+
+def export_row(fact):
+    tags = [str(t) for t in fact[7]]
+    duration = (fact[2] or get_timestamp()) - fact[1]
+    return (format_export_time(fact[1]), format_export_time(fact[2]), format_duration(duration),
+            str(fact[4]), str(fact[6]), str(fact[3]), ' '.join(tags),
+            format_fact_string(str(fact[4]), str(fact[6]), str(fact[3]), tags))
+
+
+def export_csv(facts, output):
+    writer = csv.writer(output)
+    writer.writerow(EXPORT_FIELDS)
+    for fact in facts:
+        writer.writerow(export_row(fact))
+        yield
+
+
+def export_json(facts, output):
+    for fact in facts:
+        output.write(json.dumps(dict(zip(EXPORT_FIELDS, export_row(fact)))) + '\n')
+        yield
+
+
+class FactsExport (object):
+    '''Write the facts of a range of days to a file.
+
+    Facts flow from the per-day fetch through the formatter straight into
+    the file, a chunk per main loop iteration, so neither the memory used
+    nor Kupfer's responsiveness depend on the size of the range.'''
+    CHUNK_SIZE = 500
+
+    def __init__(self, first, last, exporter, filename, finished):
+        self.filename = filename
+        self.count = 0
+        self._finished = finished
+        self._output = open(filename, 'w')
+        self._steps = exporter(iter_range_facts(first, last), self._output)
+        self._timer = scheduler.Timer()
+
+    def start(self):
+        self._timer.set_idle(self._write_chunk)
+
+    def _write_chunk(self):
+        try:
+            written = sum(1 for step in itertools.islice(self._steps, self.CHUNK_SIZE))
+        except Exception as err:
+            self._output.close()
+            show_error(err)
+            return
+        self.count += written
+        if written == self.CHUNK_SIZE:
+            self._timer.set_idle(self._write_chunk)
+            return
+        self._output.close()
+        pretty.print_debug(__name__, "Exported %d facts to %s" % (self.count, self.filename))
+        self._finished(self)
+
+
+activity_catalog = ActivityCatalog(get_cache_filename('hamster-activities.pickle'))
+activity_usage = ActivityUsage(get_cache_filename('hamster-activity-usage.pickle'))
+activity_index = ActivityIndex(activity_catalog, activity_usage)
+tag_cache = TagCache()
+facts_cache = FactsCache()
+statistics_cache = StatisticsCache(get_cache_filename('hamster-statistics.pickle'))
+fact_index = FactIndex(get_cache_filename('hamster-fact-index.pickle'))
+hamster_client.connect(fact_index.update_later)
+daily_totals = DailyTotals()
 
 
 class Toggle (Action):
@@ -104,7 +1442,7 @@ class Toggle (Action):
         yield AppLeaf
 
     def valid_for_item(self, item):
-        return item.get_id() in HAMSTER_APPNAMES and get_hamster() is not None
+        return item.get_id() in HAMSTER_APPNAMES and hamster_client.is_available
 
     def activate(self, leaf):
         get_hamster().Toggle()
@@ -125,7 +1463,7 @@ class HamsterCmdAction (Action):
         yield AppLeaf
 
     def valid_for_item(self, item):
-        return item.get_id() in HAMSTER_APPNAMES and get_hamster() is not None
+        return item.get_id() in HAMSTER_APPNAMES and hamster_client.is_available
 
     def activate(self, leaf):
         try:
@@ -175,12 +1513,13 @@ class StartActivity (Action):
     def item_types(self):
         yield TextLeaf
         yield ActivityLeaf
+        yield FactLeaf
 
-    def activate(self, leaf):
-        fact_id = get_hamster().AddFact(leaf.object, get_timestamp(), 0, False)
-        if __kupfer_settings__["return_started_facts"]:
-            fact = get_hamster().GetFact(fact_id)
-            return FactLeaf(fact)
+    def wants_context(self):
+        return True
+
+    def activate(self, leaf, ctx):
+        return start_fact(get_fact_string(leaf), ctx)
 
     def get_description(self):
         return _("Start tracking the activity in Hamster")
@@ -200,20 +1539,18 @@ class StartActivityWithTags (Action):
         yield TextLeaf
         yield ActivityLeaf
 
-    def activate(self, leaf, iobj):
-        return self.activate_multiple([leaf], [iobj])
+    def wants_context(self):
+        return True
+
+    def activate(self, leaf, iobj, ctx):
+        return self.activate_multiple([leaf], [iobj], ctx)
 
-    def activate_multiple(self, leafs, iobjs):
+    def activate_multiple(self, leafs, iobjs, ctx):
         # use the first direct object, as it makes no sense to use more than one
         # direct object for this action
         leaf = leafs[0]
         tags = ['#' + str(io.object) for io in iobjs]
-        fact = leaf.object + ', ' + ' '.join(tags)
-        pretty.print_debug(__name__, "Adding fact: " + fact)
-        fact_id = get_hamster().AddFact(fact, get_timestamp(), 0, False)
-        if __kupfer_settings__["return_started_facts"]:
-            fact = get_hamster().GetFact(fact_id)
-            return FactLeaf(fact)
+        return start_fact(leaf.object + ', ' + ' '.join(tags), ctx)
 
     def get_description(self):
         return _("Start tracking the activity with tags in Hamster")
@@ -232,7 +1569,7 @@ class StartActivityWithTags (Action):
         yield TextLeaf
 
     def object_source(self, for_item):
-        return TagsSource()
+        return TagsSource(for_item.object.split(',', 1)[0].strip())
 
     def has_result(self):
         return __kupfer_settings__["return_started_facts"]
@@ -245,12 +1582,13 @@ class StartActivityWithDescription (Action):
     def item_types(self):
         yield TextLeaf
         yield ActivityLeaf
+        yield FactLeaf
+
+    def wants_context(self):
+        return True
 
-    def activate(self, leaf, iobj):
-        fact_id = get_hamster().AddFact(leaf.object + ', ' + iobj.object, get_timestamp(), 0, False)
-        if __kupfer_settings__["return_started_facts"]:
-            fact = get_hamster().GetFact(fact_id)
-            return FactLeaf(fact)
+    def activate(self, leaf, iobj, ctx):
+        return start_fact(get_fact_string(leaf, iobj.object), ctx)
 
     def get_description(self):
         return _("Start tracking the activity with description in Hamster")
@@ -288,11 +1626,76 @@ class FactEditAction (Action):
     def get_icon_name(self):
         return "gtk-edit"
 
-    def update_fact(self, leaf):
-        fact = format_fact_string(leaf.activity, leaf.category, leaf.description, leaf.tags)
-        pretty.print_debug(__name__, "Going to update fact %d: %s" % (leaf.fact_id, fact))
-        leaf.fact_id = get_hamster().UpdateFact(leaf.fact_id, fact, leaf.starttime, leaf.endtime, False)
-        return leaf
+    def wants_context(self):
+        return True
+
+    def update_fact(self, leaf, ctx):
+        return self.update_facts([leaf], ctx)
+
+    def update_facts(self, leafs, ctx):
+        '''Store the edited `leafs` in Hamster, one UpdateFact per fact.
+
+        In asynchronous mode all calls are sent at once; a single edited fact
+        is handed back to Kupfer when Hamster has stored it.'''
+        updates = []
+        for leaf in leafs:
+            fact = format_fact_string(leaf.activity, leaf.category, leaf.description, leaf.tags)
+            pretty.print_debug(__name__, "Going to update fact %d: %s" % (leaf.fact_id, fact))
+            facts_cache.invalidate(get_fact_day(leaf.starttime))
+            tag_cache.forget_fact(format_activity(leaf.activity, leaf.category), leaf.fact_id)
+            updates.append((leaf, fact))
+        if not __kupfer_settings__["async_actions"]:
+            for leaf, fact in updates:
+                fact_id = call_hamster('UpdateFact', leaf.fact_id, fact, leaf.starttime, leaf.endtime, False)
+                if fact_id is not None:
+                    leaf.fact_id = fact_id
+            if len(leafs) == 1:
+                return leafs[0]
+            return None
+
+        def fact_updated(leaf, fact_id):
+            leaf.fact_id = fact_id
+            facts_cache.invalidate(get_fact_day(leaf.starttime))
+            if len(leafs) == 1:
+                ctx.register_late_result(leaf)
+
+        for leaf, fact in updates:
+            call_hamster('UpdateFact', leaf.fact_id, fact, leaf.starttime, leaf.endtime, False,
+                         reply_handler=functools.partial(fact_updated, leaf))
+
+
+class EditFact (FactEditAction):
+    def __init__(self):
+        Action.__init__(self, _("Edit"))
+
+    def get_description(self):
+        return _("Change the times, tags and description of Hamster activities at once "
+                 "(format: hh:mm-hh:mm #tag, description)")
+
+    def valid_object(self, iobj, for_item=None):
+        try:
+            parse_fact_edit(iobj.object)
+        except ValueError:
+            return False
+        return True
+
+    def activate(self, leaf, iobj, ctx):
+        return self.activate_multiple([leaf], [iobj], ctx)
+
+    def activate_multiple(self, leafs, iobjs, ctx):
+        # the same edit is applied to all selected facts
+        changes = parse_fact_edit(iobjs[0].object)
+        for leaf in leafs:
+            facts_cache.invalidate(get_fact_day(leaf.starttime))
+            if 'start' in changes:
+                leaf.starttime = parse_time(changes['start'], leaf.starttime)
+            if 'end' in changes:
+                leaf.endtime = parse_end_time(changes['end'], leaf.starttime)
+            if 'tags' in changes:
+                leaf.tags = changes['tags']
+            if 'description' in changes:
+                leaf.description = changes['description']
+        return self.update_facts(leafs, ctx)
 
 
 class ChangeStartTime (FactEditAction):
@@ -302,9 +1705,10 @@ class ChangeStartTime (FactEditAction):
     def get_description(self):
         return _("Change the start time (format: hh:mm) of a Hamster activty")
 
-    def activate(self, leaf, iobj):
-        leaf.starttime = parse_time(iobj.object)
-        return self.update_fact(leaf)
+    def activate(self, leaf, iobj, ctx):
+        facts_cache.invalidate(get_fact_day(leaf.starttime))
+        leaf.starttime = parse_time(iobj.object, leaf.starttime)
+        return self.update_fact(leaf, ctx)
 
     def get_gicon(self):
         return icons.ComposedIconSmall(self.get_icon_name(), "media-playback-start")
@@ -317,9 +1721,9 @@ class ChangeEndTime (FactEditAction):
     def get_description(self):
         return _("Change the end time (format: hh:mm) of a Hamster activty")
 
-    def activate(self, leaf, iobj):
-        leaf.endtime = parse_time(iobj.object)
-        return self.update_fact(leaf)
+    def activate(self, leaf, iobj, ctx):
+        leaf.endtime = parse_end_time(iobj.object, leaf.starttime)
+        return self.update_fact(leaf, ctx)
 
     def get_gicon(self):
         return icons.ComposedIconSmall(self.get_icon_name(), "media-playback-stop")
@@ -335,9 +1739,9 @@ class ChangeDescription (FactEditAction):
     def get_gicon(self):
         return icons.ComposedIconSmall(self.get_icon_name(), "txt")
 
-    def activate(self, leaf, iobj):
+    def activate(self, leaf, iobj, ctx):
         leaf.description = iobj.object
-        return self.update_fact(leaf)
+        return self.update_fact(leaf, ctx)
 
 
 class ChangeTags (FactEditAction):
@@ -350,21 +1754,21 @@ class ChangeTags (FactEditAction):
     def get_gicon(self):
         return icons.ComposedIconSmall(self.get_icon_name(), "tag-new")
 
-    def activate(self, leaf, iobj):
-        return self.activate_multiple([leaf], [iobj])
+    def activate(self, leaf, iobj, ctx):
+        return self.activate_multiple([leaf], [iobj], ctx)
 
-    def activate_multiple(self, leafs, iobjs):
+    def activate_multiple(self, leafs, iobjs, ctx):
         # we only care about the first selected leaf
         leaf = leafs[0]
         leaf.tags = [str(io.object) for io in iobjs]
-        return self.update_fact(leaf)
+        return self.update_fact(leaf, ctx)
 
     def object_types(self):
         yield TagLeaf
         yield TextLeaf
 
     def object_source(self, for_item):
-        return TagsSource()
+        return TagsSource(format_activity(for_item.activity, for_item.category))
 
 
 class Remove (Action):
@@ -381,7 +1785,119 @@ class Remove (Action):
         yield FactLeaf
 
     def activate(self, leaf):
-        get_hamster().RemoveFact(leaf.fact_id)
+        return self.activate_multiple([leaf])
+
+    def activate_multiple(self, leafs):
+        # all removals are sent at once; the catalog is refreshed once for
+        # the resulting burst of FactsChanged signals
+        start = time.time()
+        for leaf in leafs:
+            facts_cache.invalidate(get_fact_day(leaf.starttime))
+            tag_cache.forget_fact(format_activity(leaf.activity, leaf.category), leaf.fact_id)
+
+        def all_removed():
+            pretty.print_debug(__name__, "Removed %d facts in %.1fms" % (len(leafs), (time.time() - start) * 1000))
+
+        if not __kupfer_settings__["async_actions"]:
+            for leaf in leafs:
+                call_hamster('RemoveFact', leaf.fact_id)
+            all_removed()
+            return
+        pending = [len(leafs)]
+
+        def fact_removed(*reply):
+            pending[0] -= 1
+            if pending[0] == 0:
+                all_removed()
+
+        for leaf in leafs:
+            call_hamster('RemoveFact', leaf.fact_id, reply_handler=fact_removed)
+
+
+class ShowFacts (Action):
+    def __init__(self):
+        Action.__init__(self, _("Show Hamster facts"))
+
+    def get_description(self):
+        return _("Show the Hamster facts for a day (yyyy-mm-dd) or range of days (yyyy-mm-dd..yyyy-mm-dd)")
+
+    def get_icon_name(self):
+        return "hamster-applet"
+
+    def item_types(self):
+        yield TextLeaf
+
+    def valid_for_item(self, item):
+        try:
+            parse_date_range(item.object)
+        except ValueError:
+            return False
+        return hamster_client.is_available
+
+    def has_result(self):
+        return True
+
+    def activate(self, leaf):
+        first, last = parse_date_range(leaf.object)
+        return SourceLeaf(DateRangeFactsSource(first, last))
+
+
+class ExportFacts (Action):
+    '''Export the facts of a fact catalog, or of a day or range of days typed
+    as yyyy-mm-dd..yyyy-mm-dd'''
+    def __init__(self):
+        Action.__init__(self, _("Export Hamster facts"))
+
+    def get_description(self):
+        return _("Export the Hamster facts of a range of days (yyyy-mm-dd..yyyy-mm-dd) to a file")
+
+    def get_icon_name(self):
+        return "document-save-as"
+
+    def item_types(self):
+        yield TextLeaf
+        yield SourceLeaf
+
+    def valid_for_item(self, item):
+        if isinstance(item, SourceLeaf):
+            return isinstance(item.object, FactsSource) and hamster_client.is_available
+        try:
+            parse_date_range(item.object)
+        except ValueError:
+            return False
+        return hamster_client.is_available
+
+    def requires_object(self):
+        return True
+
+    def object_types(self):
+        yield ExportFormatLeaf
+
+    def object_source(self, for_item):
+        return ExportFormatsSource()
+
+    def has_result(self):
+        return True
+
+    def wants_context(self):
+        return True
+
+    def activate(self, leaf, iobj, ctx):
+        if isinstance(leaf, SourceLeaf):
+            first, last = leaf.object.get_days()
+        else:
+            first, last = parse_date_range(leaf.object)
+        basename = os.path.join(os.path.expanduser('~'), 'hamster-%s-%s' % (first.isoformat(), last.isoformat()))
+        filename = basename + iobj.extension
+        number = 1
+        while os.path.exists(filename):
+            number += 1
+            filename = '%s-%d%s' % (basename, number, iobj.extension)
+
+        def finished(export):
+            ctx.register_late_result(FileLeaf(export.filename))
+
+        FactsExport(first, last, iobj.object, filename, finished).start()
 
 
 class StopTrackingLeaf (RunnableLeaf):
@@ -398,7 +1914,7 @@ class StopTrackingLeaf (RunnableLeaf):
         return "media-playback-stop"
 
     def run(self):
-        get_hamster().StopTracking(get_timestamp())
+        call_hamster('StopTracking', get_timestamp())
 
 
 class ShowHamsterInfo (RunnableLeaf):
@@ -414,24 +1930,71 @@ class ShowHamsterInfo (RunnableLeaf):
         return "info"
 
     def run(self):
-        facts = get_hamster().GetTodaysFacts()
-        total = 0
-        current = None
-        for f in facts:
-            end = f[2]
-            if end == 0:
-                current = f
-                end = get_timestamp()
-            duration = end - f[1]
-            total += duration
-        notification_body = "Total time today: %s" % format_duration(total)
+        daily_totals.ensure_current()
+        now = get_timestamp()
+        notification_body = "Total time today: %s" % format_duration(daily_totals.get_total(now))
+        categories = daily_totals.get_categories(now)
+        for category in sorted(categories, key=categories.get, reverse=True):
+            notification_body += "\n  %s: %s" % (category or _("no category"), format_duration(categories[category]))
+        current = daily_totals.current
         if current:
             notification_body += "\nCurrent: %s@%s (%s)" % (current[4], current[6],
-                                                            format_duration(get_timestamp() - current[1]))
+                                                            format_duration(now - current[1]))
         ShowHamsterInfo.notification_id = uiutils.show_notification('Hamster Info',
                                           notification_body, 'hamster-indicator', ShowHamsterInfo.notification_id)
 
 
+class ShowHamsterStatistics (RunnableLeaf):
+    '''Show the time tracked this week, month or year per category,
+    activity and tag'''
+    notification_id = 0
+    MAX_ROWS = 5
+
+    def __init__(self, period, name):
+        RunnableLeaf.__init__(self, period, name)
+
+    def get_description(self):
+        return _("Show the time tracked per category, activity and tag")
+
+    def get_icon_name(self):
+        return "emblem-sales"
+
+    def get_first_day(self, today):
+        if self.object == 'week':
+            return today - datetime.timedelta(days=today.weekday())
+        if self.object == 'month':
+            return today.replace(day=1)
+        return today.replace(month=1, day=1)
+
+    def format_totals(self, title, totals):
+        body = "\n%s:" % title
+        for key in heapq.nlargest(self.MAX_ROWS, totals, key=totals.get):
+            body += "\n  %s: %s" % (key or _("no category"), format_duration(totals[key]))
+        return body
+
+    def run(self):
+        start = time.time()
+        today = datetime.date.today()
+        first = self.get_first_day(today)
+        missing = statistics_cache.get_missing_days(first, today)
+        if missing:
+            # show what is counted so far and update the notification once
+            # the other days are
+            statistics_cache.update_later(first, today, self.run)
+        activities, categories, tags = statistics_cache.get_totals(first, today)
+        notification_body = "Total time: %s" % format_duration(sum(categories.values()))
+        if missing:
+            notification_body += "\n" + _("Still counting %d days") % len(missing)
+        notification_body += self.format_totals(_("Categories"), categories)
+        notification_body += self.format_totals(_("Activities"), activities)
+        if tags:
+            notification_body += self.format_totals(_("Tags"), tags)
+        pretty.print_debug(__name__, "Statistics computed in %.1fms" % ((time.time() - start) * 1000))
+        ShowHamsterStatistics.notification_id = uiutils.show_notification(str(self),
+                                                notification_body, 'hamster-indicator',
+                                                ShowHamsterStatistics.notification_id)
+
+
 class ActivityLeaf (Leaf):
     def __init__(self, activity):
         Leaf.__init__(self, activity, activity)
@@ -456,25 +2019,54 @@ class TagLeaf (Leaf):
         return "tag-new"
 
 
+def fact_field(index):
+    '''A FactLeaf property for a field of the fact tuple it wraps'''
+    def get_field(leaf):
+        return leaf.fact[index]
+
+    def set_field(leaf, value):
+        fact = list(leaf.fact)
+        fact[index] = value
+        leaf.fact = tuple(fact)
+        leaf._description = None
+
+    return property(get_field, set_field)
+
+
+class ExportFormatLeaf (Leaf):
+    def __init__(self, exporter, name, extension):
+        Leaf.__init__(self, exporter, name)
+        self.extension = extension
+
+    def get_icon_name(self):
+        return "text-x-generic"
+
+
 class FactLeaf (Leaf):
     def __init__(self, fact):
         name = fact[4]
         if fact[6]:
             name += "@" + fact[6]
         Leaf.__init__(self, fact[0], name)
-        pretty.print_debug(__name__, "creating fact %d: %s" % (fact[0], name))
-        self.fact_id = fact[0]
-        self.activity = fact[4]
-        self.category = fact[6]
-        self.starttime = fact[1]
-        self.endtime = fact[2]
-        self.description = fact[3]
-        self.tags = fact[7]
+        if pretty.debug:
+            pretty.print_debug(__name__, "creating fact %d: %s" % (fact[0], name))
+        # the fact tuple is shared with the facts cache, not copied
+        self.fact = fact
+        self._description = None
+
+    fact_id = fact_field(0)
+    starttime = fact_field(1)
+    endtime = fact_field(2)
+    description = fact_field(3)
+    activity = fact_field(4)
+    category = fact_field(6)
+    tags = fact_field(7)
 
     def get_icon_name(self):
         return "hamster-indicator"
 
     def get_actions(self):
+        yield EditFact()
         yield ChangeStartTime()
         yield ChangeEndTime()
         yield ChangeDescription()
@@ -482,26 +2074,32 @@ class FactLeaf (Leaf):
         yield Remove()
 
     def get_description(self):
-        start = format_time(self.starttime)
-        end = ''
-        if self.endtime:
-            end = format_time(self.endtime)
-        return "%s - %s" % (start, end)
+        if self._description is None:
+            start = format_time(self.starttime)
+            end = ''
+            if self.endtime:
+                end = format_time(self.endtime)
+            self._description = "%s - %s" % (start, end)
+            day = get_fact_day(self.starttime)
+            if day != datetime.date.today():
+                self._description = "%s %s" % (day.isoformat(), self._description)
+            if self.description:
+                self._description += " " + self.description
+        return self._description
 
 
 class ActivitiesSource (Source):
     def __init__(self):
         Source.__init__(self, _("Hamster Activities"))
-        self.activities = get_hamster().GetActivities('')
 
     def provides(self):
         yield ActivityLeaf
 
     def get_items(self):
-        for act in self.activities:
-            activity = str(act[0])
-            if act[1]:
-                activity += '@' + str(act[1])
+        now = time.time()
+        activities = sorted(activity_catalog.activities, reverse=True,
+                            key=lambda act: activity_usage.score(act, now))
+        for activity in activities:
             yield ActivityLeaf(activity)
 
     def get_icon_name(self):
@@ -515,19 +2113,42 @@ class ActivitiesSource (Source):
 
 
 class TagsSource (Source):
-    def __init__(self):
+    '''All tags, the ones used most with `activity` first'''
+    def __init__(self, activity=None):
         Source.__init__(self, _("Hamster Tags"))
+        self.activity = activity
 
     def provides(self):
         yield TagLeaf
 
     def get_items(self):
-        return [TagLeaf(t[1]) for t in get_hamster().GetTags(True)]
+        tags = tag_cache.get_tags()
+        if self.activity:
+            counts = tag_cache.get_tag_counts(self.activity)
+            if counts:
+                tags = sorted(tags, key=lambda tag: counts.get(tag, 0), reverse=True)
+        return [TagLeaf(tag) for tag in tags]
 
 
-class FactsSource (Source):
+class ExportFormatsSource (Source):
     def __init__(self):
-        Source.__init__(self, _("Hamster Facts"))
+        Source.__init__(self, _("Export formats"))
+
+    def provides(self):
+        yield ExportFormatLeaf
+
+    def get_items(self):
+        yield ExportFormatLeaf(export_csv, _("CSV"), '.csv')
+        yield ExportFormatLeaf(export_json, _("JSON lines"), '.json')
+
+
+class FactsSource (Source):
+    '''Facts for a range of days, most recent day first.
+
+    Facts are fetched and yielded one day at a time, so a long range does
+    not have to be fetched at once.'''
+    def __init__(self, name=None):
+        Source.__init__(self, name or _("Hamster Facts"))
 
     def get_description(self):
         return _("Facts for today")
@@ -541,10 +2162,63 @@ class FactsSource (Source):
     def get_actions(self):
         return ()
 
+    def get_days(self):
+        '''Return the first and the last day of the range'''
+        today = datetime.date.today()
+        return today, today
+
     def get_items(self):
-        for fact in get_hamster().GetTodaysFacts():
-            leaf = FactLeaf(fact)
-            yield leaf
+        first, last = self.get_days()
+        # facts running past midnight are returned for both days
+        seen = set()
+        day = last
+        while day >= first:
+            for fact in facts_cache.get_facts(day):
+                if fact[0] not in seen:
+                    seen.add(fact[0])
+                    yield FactLeaf(fact)
+            day -= datetime.timedelta(days=1)
+
+
+class YesterdayFactsSource (FactsSource):
+    def __init__(self):
+        FactsSource.__init__(self, _("Hamster Facts Yesterday"))
+
+    def get_description(self):
+        return _("Facts for yesterday")
+
+    def get_days(self):
+        yesterday = datetime.date.today() - datetime.timedelta(days=1)
+        return yesterday, yesterday
+
+
+class ThisWeekFactsSource (FactsSource):
+    def __init__(self):
+        FactsSource.__init__(self, _("Hamster Facts This Week"))
+
+    def get_description(self):
+        return _("Facts for the current week")
+
+    def get_days(self):
+        today = datetime.date.today()
+        return today - datetime.timedelta(days=today.weekday()), today
+
+
+class DateRangeFactsSource (FactsSource):
+    def __init__(self, first, last):
+        if first == last:
+            name = _("Hamster Facts for %s") % first.isoformat()
+        else:
+            name = _("Hamster Facts for %s to %s") % (first.isoformat(), last.isoformat())
+        FactsSource.__init__(self, name)
+        self.first = first
+        self.last = last
+
+    def get_description(self):
+        return self.name
+
+    def get_days(self):
+        return self.first, self.last
 
 
 class HamsterSource (AppLeafContentMixin, Source):
@@ -552,34 +2226,118 @@ class HamsterSource (AppLeafContentMixin, Source):
 
     def __init__(self):
         Source.__init__(self, _("Hamster"))
+        self.activities_source = ActivitiesSource()
+        self.facts_source = FactsSource()
+        self.yesterday_facts_source = YesterdayFactsSource()
+        self.week_facts_source = ThisWeekFactsSource()
+        self._refresh_timer = scheduler.Timer()
+        self.signals_received = 0
+        self.refreshes = 0
 
     def _facts_changed(self, *args):
-        pretty.print_debug(__name__, 'facts changed')
+        # edits and sync tools emit bursts of signals, only refresh once
+        # the bus has been quiet for a while
+        self.signals_received += 1
+        facts_cache.invalidate_recent()
+        self._refresh_timer.set_ms(max(0, __kupfer_settings__["facts_changed_delay"]), self._refresh)
+
+    def _refresh(self):
+        self.refreshes += 1
+        pretty.print_debug(__name__, "facts changed: %d signals, %d refreshes, %d refreshes saved" %
+                           (self.signals_received, self.refreshes, self.signals_received - self.refreshes))
+        self.facts_source.mark_for_update()
+        self.yesterday_facts_source.mark_for_update()
+        self.week_facts_source.mark_for_update()
         self.mark_for_update()
+        activity_catalog.refresh()
+        daily_totals.refresh()
+        tag_cache.invalidate()
+
+    def _activities_changed(self):
+        self.activities_source.mark_for_update()
+        if __kupfer_settings__["toplevel_activities"]:
+            self.mark_for_update()
 
     def initialize(self):
-        dbus_signal_connect_weakly(dbus.Bus(), 'FactsChanged', self._facts_changed,
-                                   dbus_interface='org.gnome.Hamster')
+        dbus_signal_connect_weakly(hamster_client.bus, 'FactsChanged', self._facts_changed,
+                                   dbus_interface=HAMSTER_INTERFACE)
+        activity_catalog.connect(self._activities_changed)
+        activity_catalog.refresh()
+        daily_totals.refresh()
+        tag_cache.initialize()
+        command_journal.replay()
+        fact_index.update_later()
 
     def provides(self):
         yield StopTrackingLeaf
         yield ShowHamsterInfo
+        yield ShowHamsterStatistics
         yield SourceLeaf
         yield ActivityLeaf
 
     def get_items(self):
         yield StopTrackingLeaf()
         yield ShowHamsterInfo()
-        activities_source = ActivitiesSource()
-        yield SourceLeaf(activities_source)
-        facts_source = FactsSource()
-        yield SourceLeaf(facts_source)
+        yield ShowHamsterStatistics('week', _("Hamster Statistics This Week"))
+        yield ShowHamsterStatistics('month', _("Hamster Statistics This Month"))
+        yield ShowHamsterStatistics('year', _("Hamster Statistics This Year"))
+        yield SourceLeaf(self.activities_source)
+        yield SourceLeaf(self.facts_source)
+        yield SourceLeaf(self.yesterday_facts_source)
+        yield SourceLeaf(self.week_facts_source)
         if __kupfer_settings__["toplevel_activities"]:
-            for leaf in activities_source.get_leaves():
-                yield leaf
+            # the full catalog stays behind the activities SourceLeaf, only
+            # the most used activities are worth a place in the top level
+            count = __kupfer_settings__["toplevel_activities_count"]
+            if count > 0:
+                for activity in activity_usage.most_used(activity_catalog.activities, count):
+                    yield ActivityLeaf(activity)
+            else:
+                for leaf in self.activities_source.get_leaves():
+                    yield leaf
 
     def get_description(self):
         return _("Hamster time tracker")
 
     def get_icon_name(self):
         return "hamster-indicator"
+
+
+class ActivityMatchSource (TextSource):
+    '''Hamster activities matching the typed text, most used first'''
+    MAX_RESULTS = 10
+
+    def __init__(self):
+        TextSource.__init__(self, _("Hamster Activities"))
+
+    def get_rank(self):
+        return 60
+
+    def provides(self):
+        yield ActivityLeaf
+
+    def get_text_items(self, text):
+        for activity in activity_index.query(text, self.MAX_RESULTS):
+            yield ActivityLeaf(activity)
+
+
+class FactSearchSource (TextSource):
+    '''Past Hamster facts whose description or tags match the typed text,
+    most recent first'''
+    MAX_RESULTS = 10
+    MIN_LENGTH = 3
+
+    def __init__(self):
+        TextSource.__init__(self, _("Hamster Facts History"))
+
+    def get_rank(self):
+        return 50
+
+    def provides(self):
+        yield FactLeaf
+
+    def get_text_items(self, text):
+        if len(text.strip()) < self.MIN_LENGTH:
+            return
+        for fact in fact_index.query(text, self.MAX_RESULTS):
+            yield FactLeaf(fact)
@@ -7,11 +7,15 @@ __description__ = _("Control any MPRIS2 media player")
 __version__ = ""
 __author__ = "Jeroen Budts"
 
+import collections
+import functools
+
 import dbus
+import dbus.lowlevel
 
 from kupfer import pretty, plugin_support, icons, uiutils
 from kupfer.objects import Source, Leaf, Action, AppLeaf
-from kupfer.weaklib import dbus_signal_connect_weakly
+from kupfer.weaklib import dbus_signal_connect_weakly, WeakCallback
 from gio.unix import DesktopAppInfo
 from gio import FileIcon, File
 
@@ -19,32 +23,114 @@ plugin_support.check_dbus_connection()
 
 
 # {{{ supporting classes and functions
-class MediaPlayer (object):
-    def __init__(self, dbus_obj):
-        self._dbus_obj = dbus_obj
-        entry = self.get_root_property('DesktopEntry')
-        # TODO: handle case of absent DesktopEntry (DesktopEntry is optional according to MPRIS2)
-        self.desktop_app_info = DesktopAppInfo(entry + '.desktop')
+MPRIS_PATH = '/org/mpris/MediaPlayer2'
+ROOT_INTERFACE = 'org.mpris.MediaPlayer2'
+PLAYER_INTERFACE = 'org.mpris.MediaPlayer2.Player'
+PLAYLISTS_INTERFACE = 'org.mpris.MediaPlayer2.Playlists'
+PROPERTIES_INTERFACE = 'org.freedesktop.DBus.Properties'
+MPRIS_NAMESPACE = 'org.mpris.MediaPlayer2'
 
-    @property
-    def root(self):
-        return dbus.Interface(self._dbus_obj, dbus_interface='org.mpris.MediaPlayer2')
 
-    @property
-    def player(self):
-        return dbus.Interface(self._dbus_obj, dbus_interface='org.mpris.MediaPlayer2.Player')
-
-    @property
-    def playlists(self):
-        return dbus.Interface(self._dbus_obj, dbus_interface='org.mpris.MediaPlayer2.Playlists')
+class MediaPlayer (object):
+    '''A running MPRIS2 player.
+
+    All properties of the player are loaded once with GetAll and kept
+    current by the registry from its PropertiesChanged signals, so reading
+    them does not touch the bus.'''
+    # seconds a player gets to answer before it is given up on
+    LOAD_TIMEOUT = 2
+    PLAYLISTS_PAGE_SIZE = 100
+
+    def __init__(self, bus_name, owner, dbus_obj):
+        self.bus_name = bus_name
+        self.owner = owner
+        self._dbus_obj = dbus_obj
+        self.root = dbus.Interface(dbus_obj, dbus_interface=ROOT_INTERFACE)
+        self.player = dbus.Interface(dbus_obj, dbus_interface=PLAYER_INTERFACE)
+        self.playlists = dbus.Interface(dbus_obj, dbus_interface=PLAYLISTS_INTERFACE)
+        self._properties_manager = dbus.Interface(dbus_obj, PROPERTIES_INTERFACE)
+        self._properties = {}
+        self.loaded = False
+        self.desktop_app_info = None
+        self._playlists = []
+        self._playlists_complete = False
+
+    def load(self, ready, failed):
+        '''Ask for the properties of all interfaces at once without waiting
+        for the answers. `ready` is called with the player when all have
+        answered, `failed` with the player and the error when one did not.'''
+        pending = [ROOT_INTERFACE, PLAYER_INTERFACE, PLAYLISTS_INTERFACE]
+
+        def properties_received(interface, properties):
+            self._properties[interface] = dict(properties)
+            interface_done(interface)
+
+        def properties_failed(interface, err):
+            # the Playlists interface is optional, but not answering at all is
+            # not
+            timed_out = err.get_dbus_name() == 'org.freedesktop.DBus.Error.NoReply'
+            if interface != PLAYLISTS_INTERFACE or timed_out:
+                if pending:
+                    del pending[:]
+                    failed(self, err)
+                return
+            pretty.print_debug(__name__, "%s does not implement %s: %s" % (self.bus_name, interface, err))
+            interface_done(interface)
+
+        def interface_done(interface):
+            if interface not in pending:
+                return
+            pending.remove(interface)
+            if not pending:
+                entry = self.get_root_property('DesktopEntry')
+                # TODO: handle case of absent DesktopEntry (DesktopEntry is optional according to MPRIS2)
+                self.desktop_app_info = DesktopAppInfo(entry + '.desktop')
+                self.loaded = True
+                ready(self)
+
+        for interface in list(pending):
+            self._properties_manager.GetAll(interface, timeout=self.LOAD_TIMEOUT,
+                                            reply_handler=functools.partial(properties_received, interface),
+                                            error_handler=functools.partial(properties_failed, interface))
+
+    def update_properties(self, interface, changed, invalidated):
+        if interface not in self._properties:
+            return
+        properties = self._properties[interface]
+        properties.update(changed)
+        for property_name in invalidated:
+            properties.pop(property_name, None)
+        if interface == PLAYLISTS_INTERFACE and ('PlaylistCount' in changed or 'PlaylistCount' in invalidated):
+            self.invalidate_playlists()
+
+    def invalidate_playlists(self):
+        self._playlists = []
+        self._playlists_complete = False
+
+    def iter_playlists(self):
+        '''Yield the (id, name, icon) of all playlists, alphabetically.
+
+        The playlists are fetched a page at a time, only when the pages
+        before have been used, and kept until the player reports a change.'''
+        index = 0
+        while True:
+            while index < len(self._playlists):
+                yield self._playlists[index]
+                index += 1
+            if self._playlists_complete:
+                return
+            page = self.playlists.GetPlaylists(dbus.UInt32(index), dbus.UInt32(self.PLAYLISTS_PAGE_SIZE),
+                                               'Alphabetical', False)
+            # the cache may have been dropped while the caller used the
+            # previous page
+            if index != len(self._playlists):
+                return
+            self._playlists.extend(tuple(playlist) for playlist in page)
+            self._playlists_complete = len(page) < self.PLAYLISTS_PAGE_SIZE
 
     @property
     def supports_playlists(self):
-        try:
-            self.get_playlists_property('PlaylistCount')
-            return True
-        except:
-            return False
+        return 'PlaylistCount' in self._properties.get(PLAYLISTS_INTERFACE, ())
 
     @property
     def name(self):
@@ -56,17 +142,20 @@ class MediaPlayer (object):
         return playback_status == 'Playing'
 
     def _get_property(self, target, property_name):
-        properties_manager = dbus.Interface(self._dbus_obj, 'org.freedesktop.DBus.Properties')
-        return properties_manager.Get(target, property_name)
+        properties = self._properties.setdefault(target, {})
+        if property_name not in properties:
+            # only properties the player invalidated are fetched again
+            properties[property_name] = self._properties_manager.Get(target, property_name)
+        return properties[property_name]
 
     def get_player_property(self, property_name):
-        return self._get_property('org.mpris.MediaPlayer2.Player', property_name)
+        return self._get_property(PLAYER_INTERFACE, property_name)
 
     def get_root_property(self, property_name):
-        return self._get_property('org.mpris.MediaPlayer2', property_name)
+        return self._get_property(ROOT_INTERFACE, property_name)
 
     def get_playlists_property(self, property_name):
-        return self._get_property('org.mpris.MediaPlayer2.Playlists', property_name)
+        return self._get_property(PLAYLISTS_INTERFACE, property_name)
 
     @property
     def icon(self):
@@ -78,60 +167,184 @@ class MediaPlayer (object):
 
 
 class MediaPlayersRegistry (object):
+    '''The running media players.
+
+    Players are discovered in the background: the registry starts empty and
+    every player is added as soon as it has answered, all players being
+    asked at the same time. A player that does not answer in time is
+    quarantined until it shows signs of life, so it can not hold up the
+    others.
+
+    The bus daemon only sends the signals of MPRIS players, the match rules
+    leave out the property changes and names of all other applications.'''
     def __init__(self):
-        self.reindex()
+        self._bus = dbus.SessionBus()
+        self.signals_received = 0
+        self.signals_handled = 0
         self._setup_monitor()
+        self.reindex()
 
     def _setup_monitor(self):
-        dbus_signal_connect_weakly(dbus.Bus(), 'NameOwnerChanged', self._signal_update,
-                                   dbus_interface='org.freedesktop.DBus')
-        dbus_signal_connect_weakly(dbus.Bus(), 'PropertiesChanged', self._properties_changed,
-                                   dbus_interface='org.freedesktop.DBus.Properties')
-
-    def _signal_update(self, *args):
-        if len(args) > 0 and args[0].startswith('org.mpris.MediaPlayer2.'):
-            self.reindex()
-
-    def _properties_changed(self, *args):
-        if len(args) > 1 and args[0].startswith('org.mpris.MediaPlayer2.'):
-            if 'PlaybackStatus' in args[1] and args[1]['PlaybackStatus'] == 'Playing':
-                # a media player started playing. Set it as the active player
-                # find the player and store it for later use
-                self._store_playing_player()
-
-    def _store_playing_player(self):
-        for player_name in self.active_players:
-            player = self.active_players[player_name]
-            if player.is_playing:
-                self.last_used_player = player_name
+        # dbus-python has no arg0namespace keyword, so the rule is added
+        # directly and its signals are picked up by a message filter
+        self._match_rule = ("type='signal',sender='org.freedesktop.DBus',interface='org.freedesktop.DBus',"
+                            "member='NameOwnerChanged',path='/org/freedesktop/DBus',"
+                            "arg0namespace='%s'" % MPRIS_NAMESPACE)
+        self._bus.add_match_string_non_blocking(self._match_rule)
+        # held weakly like the signal receivers, so a registry left behind
+        # by a reloaded plugin does not keep handling signals; a filter
+        # returning None leaves the message to the other handlers
+        self._message_filter = WeakCallback(self._filter_message)
+        self._bus.add_message_filter(self._message_filter)
+        for interface in (ROOT_INTERFACE, PLAYER_INTERFACE, PLAYLISTS_INTERFACE):
+            dbus_signal_connect_weakly(self._bus, 'PropertiesChanged', self._properties_changed,
+                                       dbus_interface=PROPERTIES_INTERFACE, path=MPRIS_PATH,
+                                       arg0=interface, sender_keyword='sender')
+        dbus_signal_connect_weakly(self._bus, 'PlaylistChanged', self._playlist_changed,
+                                   dbus_interface=PLAYLISTS_INTERFACE, path=MPRIS_PATH,
+                                   sender_keyword='sender')
+
+    def close(self):
+        '''Stop following the players appearing and disappearing'''
+        self._bus.remove_message_filter(self._message_filter)
+        self._bus.remove_match_string_non_blocking(self._match_rule)
+
+    def _filter_message(self, connection, message):
+        if (message.get_member() == 'NameOwnerChanged' and
+                message.get_interface() == 'org.freedesktop.DBus' and
+                message.get_sender() == 'org.freedesktop.DBus'):
+            self._signal_update(*message.get_args_list())
+        return dbus.lowlevel.HANDLER_RESULT_NOT_YET_HANDLED
+
+    def _count_signal(self, handled):
+        self.signals_received += 1
+        if handled:
+            self.signals_handled += 1
+            pretty.print_debug(__name__, "signals: %d received, %d handled" %
+                               (self.signals_received, self.signals_handled))
+
+    def _signal_update(self, name, old_owner, new_owner):
+        # only the player that appeared or disappeared is touched, the
+        # others and the order in which they were active are kept
+        handled = name.startswith(MPRIS_NAMESPACE + '.')
+        self._count_signal(handled)
+        if not handled:
+            return
+        if old_owner:
+            self._remove_player(name, old_owner)
+        if new_owner:
+            self._add_player(name, new_owner)
+
+    def _properties_changed(self, interface, changed, invalidated, sender=None):
+        # the sender is the unique name of the player, which identifies it
+        # without asking any player for its state
+        player = self._owners.get(sender)
+        self._count_signal(player is not None or sender in self._quarantined)
+        if player is None:
+            if sender in self._quarantined:
+                # it is alive after all
+                self._add_player(self._quarantined.pop(sender), sender)
+            return
+        player.update_properties(interface, changed, invalidated)
+        if player.loaded and changed.get('PlaybackStatus') == 'Playing':
+            self._mark_active(player.name)
+
+    def _playlist_changed(self, playlist, sender=None):
+        player = self._owners.get(sender)
+        self._count_signal(player is not None)
+        if player is not None:
+            # a renamed playlist can move anywhere in the alphabetical order
+            player.invalidate_playlists()
+
+    def _mark_active(self, player_name):
+        self._recent_players.pop(player_name, None)
+        self._recent_players[player_name] = True
+
+    def _add_player(self, name, owner):
+        if owner in self._owners:
+            return
+        pretty.print_debug(__name__, "discovered player: " + name)
+        self._quarantined.pop(owner, None)
+        player = MediaPlayer(name, owner, self._bus.get_object(owner, MPRIS_PATH, introspect=False))
+        # known by its owner while loading, so the signals it sends in the
+        # meantime are not lost
+        self._owners[owner] = player
+        player.load(self._player_ready, self._player_failed)
+
+    def _player_ready(self, player):
+        if self._owners.get(player.owner) is not player:
+            return
+        self.active_players[player.name] = player
+        if player.is_playing:
+            self._mark_active(player.name)
+        pretty.print_debug(__name__, "registered player: %s (%s)" % (player.name, player))
+
+    def _player_failed(self, player, err):
+        if self._owners.get(player.owner) is not player:
+            return
+        pretty.print_error(__name__, "Quarantining player %s:" % player.bus_name, err)
+        del self._owners[player.owner]
+        self._quarantined[player.owner] = player.bus_name
+
+    def _remove_player(self, name, owner):
+        self._quarantined.pop(owner, None)
+        player = self._owners.pop(owner, None)
+        # several instances of a player (browser tabs, for example) share
+        # its name, only forget it when it is this instance
+        if player is None or not player.loaded or self.active_players.get(player.name) is not player:
+            return
+        pretty.print_debug(__name__, "player disappeared: " + name)
+        del self.active_players[player.name]
+        self._recent_players.pop(player.name, None)
+        # let another loaded instance take its place, a playing one first
+        others = [other for other in self._owners.values() if other.loaded and other.name == player.name]
+        if others:
+            others.sort(key=lambda other: other.is_playing)
+            self._player_ready(others[-1])
 
     def reindex(self):
         self.active_players = {}
+        # all players that are loading or loaded, by their unique bus name
+        self._owners = {}
+        # bus names of the players that did not answer, by their unique name
+        self._quarantined = {}
+        # players in the order they last started playing, most recent last
+        self._recent_players = collections.OrderedDict()
 
-        bus = dbus.SessionBus()
-        dbusObj = bus.get_object('org.freedesktop.DBus', '/')
-        for name in dbusObj.ListNames(dbus_interface='org.freedesktop.DBus'):
-            if name.startswith('org.mpris.MediaPlayer2.'):
-                pretty.print_debug(__name__, "discovered player: " + name)
-                dbus_obj = bus.get_object(name, '/org/mpris/MediaPlayer2')
-                player = MediaPlayer(dbus_obj)
-                self.active_players[player.name] = player
-                pretty.print_debug(__name__, "registered player: %s (%s)" % (player.name, player))
-        self.last_used_player = ""
-        self._store_playing_player()
+        dbusObj = self._bus.get_object('org.freedesktop.DBus', '/')
+
+        def owner_received(name, owner):
+            self._add_player(name, owner)
+
+        def names_received(names):
+            for name in names:
+                if name.startswith(MPRIS_NAMESPACE + '.'):
+                    dbusObj.GetNameOwner(name, dbus_interface='org.freedesktop.DBus',
+                                         reply_handler=functools.partial(owner_received, name),
+                                         error_handler=discovery_failed)
+
+        def discovery_failed(err):
+            pretty.print_error(__name__, "Could not discover media players:", err)
+
+        dbusObj.ListNames(dbus_interface='org.freedesktop.DBus',
+                          reply_handler=names_received, error_handler=discovery_failed)
+
+    @property
+    def last_used_player(self):
+        return next(reversed(self._recent_players), "")
 
     @property
     def players(self):
-        # then return all the other players
+        # first return the players that never played
         for player in self.active_players:
-            if player != self.last_used_player:
+            if player not in self._recent_players:
                 pretty.print_debug(__name__, "other player: " + player)
                 yield player
-        # if there is an active player, return that last so it will be
-        # suggested
-        if self.last_used_player:
-            pretty.print_debug(__name__, "active player: " + self.last_used_player)
-            yield self.last_used_player
+        # then the players that played, the most recently active last so it
+        # will be suggested
+        for player in self._recent_players:
+            pretty.print_debug(__name__, "recent player: " + player)
+            yield player
 
     def get_player(self, name):
         return self.active_players[name]
@@ -163,6 +376,10 @@ track: {2} - duration: {3}""".format(artist, album, track_nr, duration)
 media_players_registry = MediaPlayersRegistry()
 
 
+def finalize_plugin(name):
+    media_players_registry.close()
+
+
 class RunningMediaPlayerTarget (Action):
     def __init__(self, player):
         self._player = media_players_registry.get_player(player)
@@ -490,9 +707,16 @@ class PlaylistLeaf (Leaf):
     def __init__(self, playlist_id, playlist_name, icon):
         Leaf.__init__(self, playlist_id, playlist_name)
         self.icon = icon
+        self._gicon = None
 
     def get_gicon(self):
-        return FileIcon(File(self.icon))
+        # only the playlists that are shown need an icon
+        if self._gicon is None and self.icon:
+            self._gicon = FileIcon(File(self.icon))
+        return self._gicon
+
+    def get_icon_name(self):
+        return "audio-x-playlist"
 # }}}
 
 
@@ -542,11 +766,8 @@ class PlaylistSource (Source):
     def provides(self):
         yield PlaylistLeaf
 
-    def should_sort_lexically(self):
-        return True
-
     def get_items(self):
-        playlists = self.player.playlists.GetPlaylists(0, 100, 'Alphabetical', False)
-        return [PlaylistLeaf(p[0], p[1], p[2]) for p in playlists]
+        for playlist_id, name, icon in self.player.iter_playlists():
+            yield PlaylistLeaf(playlist_id, name, icon)
 
 # vim: fdm=marker